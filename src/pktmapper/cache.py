@@ -0,0 +1,249 @@
+"""
+On-disk cache of the nDPI ground truth
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+import hashlib
+import os
+import struct
+import tempfile
+
+
+MAGIC = "PMGT"
+VERSION = 1
+
+# Bytes hashed from the head and the tail of the file
+HASH_EDGE = 1 << 20
+# Blocks hashed from the middle of the file
+HASH_BLOCKS = 16
+HASH_BLOCK = 1 << 16
+
+DEFAULT_DIR = os.path.join("~", ".cache", "pktmapper")
+DEFAULT_SIZE = 1 << 30
+
+# magic, version, has unknown, known (packets, bytes, flows),
+# unknown (packets, bytes, flows), names, flows
+_HEADER = struct.Struct("<4sHB3Q3QII")
+_NAME = struct.Struct("<H")
+# flow key, code of the name
+_FLOW = struct.Struct("<13sH")
+
+
+def fingerprint(filename):
+    """
+    Fast identity of the file content: size, mtime and hash of the
+    head, the tail and some blocks from the middle.
+
+    Returns:
+        str: hex digest
+    """
+    stat = os.stat(filename)
+    size = stat.st_size
+
+    digest = hashlib.sha1()
+    digest.update("{0}:{1!r}".format(size, stat.st_mtime))
+
+    with open(filename, "rb") as f:
+        digest.update(f.read(HASH_EDGE))
+        if size > 2 * HASH_EDGE:
+            step = (size - 2 * HASH_EDGE) // (HASH_BLOCKS + 1)
+            for i in range(1, HASH_BLOCKS + 1):
+                f.seek(HASH_EDGE + i * step)
+                digest.update(f.read(HASH_BLOCK))
+        if size > HASH_EDGE:
+            f.seek(max(size - HASH_EDGE, HASH_EDGE))
+            digest.update(f.read(HASH_EDGE))
+
+    return digest.hexdigest()
+
+
+def dumps(dpi):
+    """
+    Serialize ground truth produced by preprocessing.ndpi_processing.
+
+    Returns:
+        str: binary entry of the cache
+    """
+    general = dpi["general"]
+    known = general.get("known", (0, 0, 0))
+    unknown = general.get("unknown")
+
+    codes = {}
+    names = []
+    flows = []
+    for fid, name in dpi["flows"].iteritems():
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(names)
+            names.append(name)
+        flows.append(_FLOW.pack(fid, code))
+
+    parts = [_HEADER.pack(
+        MAGIC, VERSION, unknown is not None,
+        known[0], known[1], known[2],
+        *((unknown or (0, 0, 0)) + (len(names), len(flows)))
+    )]
+    for name in names:
+        raw = name.encode("utf-8")
+        parts.append(_NAME.pack(len(raw)))
+        parts.append(raw)
+    parts.extend(flows)
+
+    return "".join(parts)
+
+
+def loads(raw):
+    """
+    Deserialize the entry made by dumps.
+
+    Returns:
+        dict: ground truth as preprocessing.ndpi_processing returns
+    Raises:
+        ValueError: entry is corrupted or has another version
+    """
+    try:
+        header = _HEADER.unpack_from(raw)
+    except struct.error:
+        raise ValueError("Truncated cache entry")
+
+    magic, version, has_unknown = header[:3]
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Unsupported cache entry")
+    known = header[3:6]
+    unknown = header[6:9]
+    n_names, n_flows = header[9:]
+
+    offset = _HEADER.size
+    names = []
+    for _ in xrange(n_names):
+        if offset + _NAME.size > len(raw):
+            raise ValueError("Truncated cache entry")
+        length, = _NAME.unpack_from(raw, offset)
+        offset += _NAME.size
+        if offset + length > len(raw):
+            raise ValueError("Truncated cache entry")
+        # UnicodeDecodeError is a ValueError too
+        names.append(raw[offset:offset + length].decode("utf-8"))
+        offset += length
+
+    if len(raw) != offset + n_flows * _FLOW.size:
+        raise ValueError("Truncated cache entry")
+
+    unpack = _FLOW.unpack_from
+    flows = {}
+    for offset in xrange(offset, len(raw), _FLOW.size):
+        fid, code = unpack(raw, offset)
+        if code >= len(names):
+            raise ValueError("Corrupted cache entry")
+        flows[fid] = names[code]
+
+    general = {"known": known}
+    if has_unknown:
+        general["unknown"] = unknown
+
+    return {"general": general, "flows": flows}
+
+
+class Cache(object):
+    """
+    Content addressed cache of the ground truth of pcap files.
+
+    Entries are named by the fingerprint of the capture, so a renamed
+    or copied file is found too. When the directory grows over the
+    size limit the least recently used entries are removed.
+    """
+
+    def __init__(self, directory=None, size=None):
+        """
+        Args:
+            directory: where entries are stored
+            size: limit of the directory size in bytes
+        """
+        if directory is None:
+            directory = DEFAULT_DIR
+        if size is None:
+            size = DEFAULT_SIZE
+
+        self.directory = os.path.expanduser(directory)
+        self.size = size
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another process meanwhile
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".gt")
+
+    def get(self, filename):
+        """
+        Cached ground truth of the capture.
+
+        Returns:
+            tuple: (dict or None, key). The key is for put.
+        """
+        key = fingerprint(filename)
+        path = self._path(key)
+
+        try:
+            with open(path, "rb") as f:
+                dpi = loads(f.read())
+        except IOError:
+            return None, key
+        except ValueError:
+            self._remove(path)
+            return None, key
+
+        try:
+            # used right now
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return dpi, key
+
+    def put(self, key, dpi):
+        """
+        Store the ground truth and evict old entries if needed.
+        """
+        handle, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            f.write(dumps(dpi))
+        os.rename(tmp, self._path(key))
+
+        self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".gt"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        # The newest entry is kept even if it doesn't fit alone
+        for mtime, size, path in entries[:-1]:
+            if total <= self.size:
+                break
+            self._remove(path)
+            total -= size
@@ -22,6 +22,18 @@ def ip2str(address):
     return socket.inet_ntop(socket.AF_INET, address)
 
 
+def str2ip(address):
+    """
+    Convert a readable IP address to the inet struct.
+
+    Args:
+        address (str): Printable/readable IP address
+    Returns:
+        inet struct: inet network address (4 raw bytes)
+    """
+    return socket.inet_pton(socket.AF_INET, address)
+
+
 def ip2long(ip):
     """
     Convert an IP string to long.
@@ -0,0 +1,154 @@
+"""
+Binary columnar dataset of flow features
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from flow import FEATURES
+
+import numpy as np
+import os
+import struct
+
+
+FEATURES_FILE = "features.npy"
+LABELS_FILE = "labels.npy"
+CLASSES_FILE = "classes.npy"
+
+FEATURES_DTYPE = np.dtype("<f4")
+LABELS_DTYPE = np.dtype("<i2")
+
+# NPY header of the appendable files is written with this size, so it
+# can be rewritten in place when the number of rows changes
+_HEADER_LEN = 128
+_MAGIC = "\x93NUMPY\x01\x00"
+
+
+def _header(dtype, shape):
+    header = "{{'descr': {0!r}, 'fortran_order': False, " \
+        "'shape': {1!r}, }}".format(
+            np.lib.format.dtype_to_descr(dtype), shape)
+    size = _HEADER_LEN - len(_MAGIC) - 2
+    return _MAGIC + struct.pack("<H", size) + header.ljust(size - 1) + "\n"
+
+
+class Writer(object):
+    """
+    Appends flows to the dataset directory:
+
+        features.npy - float32 (rows, 24) in the order of FEATURES
+        labels.npy - int16 (rows,) codes of the applications
+        classes.npy - names of the applications by code
+
+    Files are plain npy, so they can be memory mapped by numpy.load.
+    An existing dataset is extended.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        features = os.path.join(path, FEATURES_FILE)
+        labels = os.path.join(path, LABELS_FILE)
+
+        self.classes = []
+        if os.path.exists(features):
+            self.rows = len(np.load(features, mmap_mode="r"))
+            self.classes = np.load(
+                os.path.join(path, CLASSES_FILE)).tolist()
+            self._features = open(features, "r+b")
+            self._labels = open(labels, "r+b")
+            # Rows written after the last update of the header are lost
+            self.truncate(self.rows)
+        else:
+            self.rows = 0
+            self._features = open(features, "w+b")
+            self._labels = open(labels, "w+b")
+            self._features.write(
+                _header(FEATURES_DTYPE, (0, len(FEATURES))))
+            self._labels.write(_header(LABELS_DTYPE, (0,)))
+
+        self._codes = dict((name, code)
+                           for code, name in enumerate(self.classes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, features, labels):
+        """
+        Append flows.
+
+        Args:
+            features: (rows, 24) matrix in the order of FEATURES
+            labels: application names of the rows
+        """
+        codes = []
+        for name in labels:
+            code = self._codes.get(name)
+            if code is None:
+                code = self._codes[name] = len(self.classes)
+                self.classes.append(name)
+            codes.append(code)
+
+        features = np.asarray(features, dtype=FEATURES_DTYPE)
+        self._features.write(features.tostring())
+        self._labels.write(np.array(codes, dtype=LABELS_DTYPE).tostring())
+        self.rows += len(codes)
+
+    def truncate(self, rows):
+        """
+        Drop rows after the first ones.
+        """
+        self.rows = min(rows, self.rows)
+        for f, dtype, width in (
+                (self._features, FEATURES_DTYPE, len(FEATURES)),
+                (self._labels, LABELS_DTYPE, 1)):
+            f.truncate(_HEADER_LEN + self.rows * width * dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+
+    def flush(self):
+        """
+        Update headers with the number of rows and save classes.
+        Rows written before are kept even if the writer isn't closed.
+        """
+        np.save(os.path.join(self.path, CLASSES_FILE),
+                np.array([unicode(i) for i in self.classes]))
+
+        for f, dtype, shape in (
+                (self._features, FEATURES_DTYPE, (self.rows, len(FEATURES))),
+                (self._labels, LABELS_DTYPE, (self.rows,))):
+            f.flush()
+            f.seek(0)
+            f.write(_header(dtype, shape))
+            f.seek(0, os.SEEK_END)
+            f.flush()
+
+    def close(self):
+        self.flush()
+        self._features.close()
+        self._labels.close()
+
+
+def is_dataset(path):
+    return os.path.isfile(os.path.join(path, FEATURES_FILE))
+
+
+def load(path, mmap_mode="r"):
+    """
+    Load the dataset. Features and labels are memory mapped.
+
+    Returns:
+        tuple: (features, labels, classes) numpy arrays
+    """
+    features = np.load(os.path.join(path, FEATURES_FILE), mmap_mode)
+    labels = np.load(os.path.join(path, LABELS_FILE), mmap_mode)
+    classes = np.load(os.path.join(path, CLASSES_FILE))
+
+    return features, labels, classes
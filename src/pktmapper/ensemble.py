@@ -0,0 +1,261 @@
+"""
+Tree ensembles compiled into flat arrays
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+import numpy as np
+
+
+TREE = "tree"
+FOREST = "forest"
+BOOSTING = "boosting"
+
+# sklearn trees compare features as float32 with float64 thresholds
+FEATURES_DTYPE = np.float32
+
+
+class Ensemble(object):
+    """
+    Trees of a fitted sklearn classifier as numpy arrays of nodes.
+
+    Nodes of all trees are numbered together. Children of a node are
+    stored as (right, left) pairs, a leaf is a child of itself. All
+    samples walk all trees at once, one level per step, walks which
+    reached a leaf drop out. Every node has the value the tree adds to
+    the decision in the leaf, the decision is the sum over trees in
+    the order of trees as sklearn sums it. So predictions are exactly
+    the same as the model gives.
+    """
+
+    def __init__(self, kind, classes, roots, features, thresholds,
+                 children, values, divisor=1.0):
+        """
+        Args:
+            kind: TREE, FOREST or BOOSTING
+            classes: labels in the order of the columns of values
+            roots: node of the root of every tree
+            features: feature compared in the node
+            thresholds: go left if the feature is less or equal
+            children: (2 * nodes,) right and left child of every node
+            values: (nodes, classes) decision of the leaf
+            divisor: the sum of trees is divided by it
+        """
+        self.kind = kind
+        self.classes_ = np.asarray(classes)
+        self.roots = np.asarray(roots, dtype=np.intp)
+        self.features = np.asarray(features, dtype=np.intp)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.children = np.asarray(children, dtype=np.intp)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.divisor = float(divisor)
+
+        self.leaf = self.children[0::2] == np.arange(len(self.features))
+
+    def __len__(self):
+        return len(self.roots)
+
+    def leaves(self, X):
+        """
+        Leaf of every tree for every sample.
+
+        Args:
+            X: (samples, features) matrix
+        Returns:
+            numpy.ndarray: (trees, samples) nodes
+        """
+        # float32 values are exact in float64, compared as sklearn does
+        X = np.asarray(X, dtype=FEATURES_DTYPE).astype(np.float64)
+        samples, width = X.shape
+        X = X.ravel()
+
+        nodes = np.repeat(self.roots, samples)
+        rows = np.tile(np.arange(samples) * width, len(self.roots))
+        walks = np.flatnonzero(~self.leaf.take(nodes))
+        while len(walks):
+            current = nodes.take(walks)
+            left = X.take(rows.take(walks) + self.features.take(current)) \
+                <= self.thresholds.take(current)
+            current = self.children.take(2 * current + left)
+            nodes[walks] = current
+            walks = walks[~self.leaf.take(current)]
+
+        return nodes.reshape(len(self.roots), samples)
+
+    def decision_function(self, X):
+        """
+        Returns:
+            numpy.ndarray: decision of the model, (samples, classes) or
+                (samples,) for the binary boosting as sklearn returns
+        """
+        decision = self.values[self.leaves(X)].sum(axis=0)
+        if self.kind == TREE:
+            return decision
+
+        decision /= self.divisor
+        if self.kind == BOOSTING and len(self.classes_) == 2:
+            decision[:, 0] *= -1
+            return decision.sum(axis=1)
+
+        return decision
+
+    def predict(self, X):
+        """
+        Predict classes for X as the model does.
+
+        Args:
+            X: (samples, features) matrix
+        Returns:
+            numpy.ndarray: labels of the samples
+        """
+        decision = self.decision_function(X)
+
+        if decision.ndim == 1:
+            return self.classes_.take(decision > 0, axis=0)
+
+        return self.classes_.take(np.argmax(decision, axis=1), axis=0)
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            np.savez(
+                f,
+                kind=np.array(self.kind),
+                classes=self.classes_,
+                roots=self.roots,
+                features=self.features,
+                thresholds=self.thresholds,
+                children=self.children,
+                values=self.values,
+                divisor=np.array(self.divisor)
+            )
+
+
+def load(filename):
+    """
+    Load the ensemble saved by Ensemble.save.
+    """
+    data = np.load(filename)
+    try:
+        return Ensemble(
+            str(data["kind"]), data["classes"], data["roots"],
+            data["features"], data["thresholds"], data["children"],
+            data["values"], data["divisor"]
+        )
+    finally:
+        data.close()
+
+
+def is_compiled(filename):
+    """
+    Is the file saved by Ensemble.save: npz is a zip archive.
+    """
+    with open(filename, "rb") as f:
+        return f.read(4) == "PK\x03\x04"
+
+
+def _proba(tree):
+    """
+    Leaf values as DecisionTreeClassifier.predict_proba gives them.
+    """
+    proba = tree.tree_.value[:, 0, :tree.n_classes_].copy()
+    normalizer = proba.sum(axis=1)[:, np.newaxis]
+    normalizer[normalizer == 0.0] = 1.0
+    proba /= normalizer
+    return proba
+
+
+def _samme_r(tree, n_classes):
+    """
+    Leaf values as weight_boosting._samme_proba gives them.
+    """
+    proba = _proba(tree)
+    np.clip(proba, np.finfo(proba.dtype).eps, None, out=proba)
+    log_proba = np.log(proba)
+
+    return (n_classes - 1) * (log_proba - (1. / n_classes) *
+                              log_proba.sum(axis=1)[:, np.newaxis])
+
+
+def _samme(tree, classes, weight):
+    """
+    Leaf values as the weighted vote of SAMME.
+    """
+    value = tree.tree_.value[:, 0, :tree.n_classes_]
+    predicted = tree.classes_.take(np.argmax(value, axis=1), axis=0)
+    return (predicted == classes[:, np.newaxis]).T * weight
+
+
+def compile_model(model):
+    """
+    Compile the fitted DecisionTreeClassifier, RandomForestClassifier,
+    ExtraTreesClassifier or AdaBoostClassifier of trees.
+
+    Returns:
+        Ensemble
+    Raises:
+        ValueError: the model can't be compiled
+    """
+    from sklearn.ensemble import AdaBoostClassifier
+    from sklearn.ensemble.forest import ForestClassifier
+    from sklearn.tree import DecisionTreeClassifier
+
+    if isinstance(model, DecisionTreeClassifier):
+        kind = TREE
+        trees = [model]
+        # predict takes argmax of the raw leaf values
+        values = [model.tree_.value[:, 0, :model.n_classes_]]
+        divisor = 1.0
+    elif isinstance(model, ForestClassifier):
+        kind = FOREST
+        trees = model.estimators_
+        values = [_proba(tree) for tree in trees]
+        divisor = len(trees)
+    elif isinstance(model, AdaBoostClassifier):
+        kind = BOOSTING
+        trees = model.estimators_
+        if model.algorithm == "SAMME.R":
+            values = [_samme_r(tree, model.n_classes_) for tree in trees]
+        else:
+            values = [_samme(tree, model.classes_, weight) for tree, weight
+                      in zip(trees, model.estimator_weights_)]
+        divisor = model.estimator_weights_.sum()
+    else:
+        raise ValueError(
+            "Can't compile {0}".format(type(model).__name__))
+
+    for tree in trees:
+        if not isinstance(tree, DecisionTreeClassifier) or \
+                tree.n_outputs_ != 1:
+            raise ValueError("Only single output trees can be compiled")
+
+    roots = []
+    features = []
+    thresholds = []
+    children = []
+    offset = 0
+    for tree in trees:
+        structure = tree.tree_
+        nodes = np.arange(structure.node_count)
+        leaf = structure.children_left == -1
+
+        # Leaves point to themselves, their feature is never used
+        left = np.where(leaf, nodes, structure.children_left) + offset
+        right = np.where(leaf, nodes, structure.children_right) + offset
+        pairs = np.empty(2 * len(nodes), dtype=np.intp)
+        pairs[0::2] = right
+        pairs[1::2] = left
+
+        roots.append(offset)
+        features.append(np.where(leaf, 0, structure.feature))
+        thresholds.append(structure.threshold)
+        children.append(pairs)
+        offset += len(nodes)
+
+    return Ensemble(
+        kind, model.classes_, roots, np.concatenate(features),
+        np.concatenate(thresholds), np.concatenate(children),
+        np.concatenate(values), divisor
+    )
@@ -0,0 +1,152 @@
+"""
+Flow expiry by idle and active timeouts
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from heapq import heappop
+from heapq import heappush
+
+
+class Expiry(object):
+    """
+    Idle and active timeouts of flows driven by packet timestamps.
+
+    Flows are kept in a timer wheel with slots of tick seconds. A packet
+    only updates the last seen timestamp; the flow is rescheduled when
+    its slot comes and the real deadline turns out to be later. So every
+    flow is touched by the wheel at most once per timeout and the cost
+    of a packet is O(1).
+
+    Time never goes back: the wheel runs on the latest timestamp seen,
+    so out of order packets of merged captures don't rewind it. Empty
+    slots are skipped, the wheel jumps to the earliest occupied one.
+
+    Entries of discarded flows stay in their slots. Every flow keeps the
+    slot of its current entry, stale ones are skipped when their slot
+    comes, so a flow which is discarded and added again is on the wheel
+    once.
+    """
+
+    def __init__(self, idle=None, active=None, tick=1.0):
+        """
+        Args:
+            idle: seconds without packets before the flow expires
+            active: seconds since the first packet before the flow expires
+            tick: resolution of the timeouts
+        """
+        self.idle = idle
+        self.active = active
+        self.tick = float(tick)
+
+        self.first = {}
+        self.last = {}
+        self.wheel = {}
+        # occupied slots of the wheel
+        self.slots = []
+        # flow key: slot of its current entry
+        self.scheduled = {}
+        self.now = None
+
+    def __len__(self):
+        return len(self.last)
+
+    @property
+    def enabled(self):
+        return self.idle is not None or self.active is not None
+
+    def _deadline(self, key):
+        deadline = float("inf")
+        if self.idle is not None:
+            deadline = self.last[key] + self.idle
+        if self.active is not None:
+            deadline = min(deadline, self.first[key] + self.active)
+
+        return deadline
+
+    def _schedule(self, key, deadline):
+        slot = int(deadline // self.tick)
+        self.scheduled[key] = slot
+        if slot in self.wheel:
+            self.wheel[slot].append(key)
+        else:
+            self.wheel[slot] = [key]
+            heappush(self.slots, slot)
+
+    def add(self, key, timestamp):
+        """
+        Start watching the flow.
+        """
+        self.first[key] = timestamp
+        self.last[key] = timestamp
+        self._schedule(key, self._deadline(key))
+
+    def touch(self, key, timestamp):
+        """
+        Register a packet of the flow.
+        """
+        if timestamp > self.last[key]:
+            self.last[key] = timestamp
+
+    def discard(self, key):
+        """
+        Stop watching the flow.
+        """
+        self.first.pop(key, None)
+        self.last.pop(key, None)
+        self.scheduled.pop(key, None)
+
+    def expire(self, timestamp):
+        """
+        Advance the wheel up to the timestamp.
+
+        Returns:
+            list: keys of the expired flows. They are not watched anymore.
+        """
+        if self.now is not None and timestamp < self.now:
+            timestamp = self.now
+        self.now = timestamp
+
+        slot = int(timestamp // self.tick)
+        slots = self.slots
+
+        expired = []
+        scheduled = self.scheduled
+        while slots and slots[0] < slot:
+            current = heappop(slots)
+            for key in self.wheel.pop(current):
+                if scheduled.get(key) != current:
+                    # discarded, or the entry of the previous watch
+                    continue
+
+                deadline = self._deadline(key)
+                if deadline <= timestamp:
+                    expired.append(key)
+                    del self.first[key]
+                    del self.last[key]
+                    del scheduled[key]
+                else:
+                    # Later than the timestamp, so not in a passed slot
+                    self._schedule(key, deadline)
+
+        return expired
+
+    def flush(self):
+        """
+        Expire everything.
+
+        Returns:
+            list: keys of all watched flows
+        """
+        expired = self.last.keys()
+
+        self.first = {}
+        self.last = {}
+        self.wheel = {}
+        self.slots = []
+        self.scheduled = {}
+
+        return expired
@@ -0,0 +1,240 @@
+"""
+Flow record
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from stats import Moments
+
+
+# Names of the exported features in the order of Flow.features()
+FEATURES = (
+    "count_dir",
+    "count_back",
+    "overall_dir",
+    "overall_back",
+    "max_itime_dir",
+    "max_itime_back",
+    "min_itime_dir",
+    "min_itime_back",
+    "avg_itime_dir",
+    "avg_itime_back",
+    "std_itime_dir",
+    "std_itime_back",
+    "var_itime_dir",
+    "var_itime_back",
+    "max_payload_dir",
+    "max_payload_back",
+    "min_payload_dir",
+    "min_payload_back",
+    "avg_payload_dir",
+    "avg_payload_back",
+    "std_payload_dir",
+    "std_payload_back",
+    "var_payload_dir",
+    "var_payload_back"
+)
+
+
+class Flow(object):
+    """
+    Mutable flow record. Metrics are updated in place on every packet.
+
+    Direction is fixed by the first packet of the flow: packets to the
+    same destination are "dir", the others are "back". Inter arrival
+    times are the gaps between consecutive packets of one direction.
+    """
+
+    __slots__ = (
+        #
+        # general metrics
+        #
+        "app",
+        "count_dir",
+        "count_back",
+        "overall_dir",
+        "overall_back",
+        #
+        # streaming statistics
+        #
+        "itime_dir",
+        "itime_back",
+        "payload_dir",
+        "payload_back",
+        #
+        # intermediate values for calculations
+        #
+        "first_dir",        # timestamp of the first packet in dir
+        "first_back",       # timestamp of the first packet in back
+        "last_dir",         # timestamp of the last packet in dir
+        "last_back",        # timestamp of the last packet in back
+        "origin"            # ip of the first packet. For determining dir
+    )
+
+    def __init__(self, app, payload, timestamp, ip):
+        self.app = app
+        self.count_dir = 1
+        self.count_back = 0
+        self.overall_dir = payload
+        self.overall_back = 0
+
+        self.itime_dir = Moments()
+        self.itime_back = Moments()
+        self.payload_dir = Moments()
+        self.payload_back = Moments()
+        self.payload_dir.push(payload)
+
+        self.first_dir = timestamp
+        self.first_back = 0
+        self.last_dir = timestamp
+        self.last_back = 0
+        self.origin = ip
+
+    @property
+    def packets(self):
+        """
+        Packets in both directions.
+        """
+        return self.count_dir + self.count_back
+
+    def update(self, payload, timestamp, ip):
+        """
+        Recalculate metrics with a new packet.
+        """
+        if ip == self.origin:
+            self.count_dir += 1
+            self.overall_dir += payload
+
+            if self.payload_dir.count:
+                self.itime_dir.push(timestamp - self.last_dir)
+            else:
+                self.first_dir = timestamp
+            self.payload_dir.push(payload)
+            self.last_dir = timestamp
+        else:
+            self.count_back += 1
+            self.overall_back += payload
+
+            if self.payload_back.count:
+                self.itime_back.push(timestamp - self.last_back)
+            else:
+                self.first_back = timestamp
+            self.payload_back.push(payload)
+            self.last_back = timestamp
+
+    def count(self, payload, ip):
+        """
+        Update only counters. Without math.
+        """
+        if ip == self.origin:
+            self.count_dir += 1
+            self.overall_dir += payload
+        else:
+            self.count_back += 1
+            self.overall_back += payload
+
+    def merge(self, other):
+        """
+        Combine with the record of the same flow built from later packets
+        (e.g. the next part of the capture processed by another worker).
+
+        Args:
+            other: Flow instance
+        Returns:
+            Flow: self
+        """
+        if other.origin == self.origin:
+            parts = (
+                (other.count_dir, other.overall_dir, other.itime_dir,
+                 other.payload_dir, other.first_dir, other.last_dir),
+                (other.count_back, other.overall_back, other.itime_back,
+                 other.payload_back, other.first_back, other.last_back)
+            )
+        else:
+            # The other part has seen the back direction first
+            parts = (
+                (other.count_back, other.overall_back, other.itime_back,
+                 other.payload_back, other.first_back, other.last_back),
+                (other.count_dir, other.overall_dir, other.itime_dir,
+                 other.payload_dir, other.first_dir, other.last_dir)
+            )
+        (count, overall, itime, payload, first, last) = parts[0]
+
+        self.count_dir += count
+        self.overall_dir += overall
+        if payload.count:
+            if self.payload_dir.count:
+                self.itime_dir.push(first - self.last_dir)
+            else:
+                self.first_dir = first
+            self.last_dir = last
+        self.itime_dir.merge(itime)
+        self.payload_dir.merge(payload)
+
+        (count, overall, itime, payload, first, last) = parts[1]
+
+        self.count_back += count
+        self.overall_back += overall
+        if payload.count:
+            if self.payload_back.count:
+                self.itime_back.push(first - self.last_back)
+            else:
+                self.first_back = first
+            self.last_back = last
+        self.itime_back.merge(itime)
+        self.payload_back.merge(payload)
+
+        return self
+
+    def counters(self):
+        """
+        Returns:
+            tuple: (app, count_dir, count_back, overall_dir, overall_back)
+        """
+        return (
+            self.app,
+            self.count_dir,
+            self.count_back,
+            self.overall_dir,
+            self.overall_back
+        )
+
+    def features(self):
+        """
+        Returns:
+            tuple: feature vector in the order of FEATURES
+        """
+        itime_dir = self.itime_dir
+        itime_back = self.itime_back
+        payload_dir = self.payload_dir
+        payload_back = self.payload_back
+
+        return (
+            self.count_dir,
+            self.count_back,
+            self.overall_dir,
+            self.overall_back,
+            itime_dir.max,
+            itime_back.max,
+            itime_dir.min,
+            itime_back.min,
+            itime_dir.mean,
+            itime_back.mean,
+            itime_dir.std,
+            itime_back.std,
+            itime_dir.range,
+            itime_back.range,
+            payload_dir.max,
+            payload_back.max,
+            payload_dir.min,
+            payload_back.min,
+            payload_dir.mean,
+            payload_back.mean,
+            payload_dir.std,
+            payload_back.std,
+            payload_dir.range,
+            payload_back.range
+        )
@@ -0,0 +1,251 @@
+"""
+Columnar flow table
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from flow import FEATURES
+from flow import Flow
+
+import numpy as np
+
+
+#
+# counter columns: they lead FEATURES, the statistics follow them
+#
+COUNT_DIR = FEATURES.index("count_dir")
+COUNT_BACK = FEATURES.index("count_back")
+OVERALL_DIR = FEATURES.index("overall_dir")
+OVERALL_BACK = FEATURES.index("overall_back")
+COUNTERS = 4
+
+# Statistics are stored with the precision the classifiers use
+STATS_DTYPE = np.float32
+COUNTS_DTYPE = np.int64
+
+# Statistics columns which are integers in the Flow record
+INTEGER_STATS = tuple(
+    FEATURES.index(name) - COUNTERS for name in (
+        "max_payload_dir",
+        "max_payload_back",
+        "min_payload_dir",
+        "min_payload_back",
+        "var_payload_dir",
+        "var_payload_back"
+    )
+)
+
+NO_APP = -1
+
+# Slices of the flow key with ip addresses of the endpoints
+LOW_IP = slice(0, 4)
+HIGH_IP = slice(6, 10)
+
+
+class FlowTable(object):
+    """
+    Flows of the capture in two parts.
+
+    Flows under the threshold are Flow records which are updated in
+    place on every packet. When the flow reaches the threshold its
+    statistics are final, freeze() moves it into a row of preallocated
+    typed columns: float32 statistics, int64 counters, the timestamp
+    of the first packet, a direction flag and an int16 application
+    code. Only the counters of a row change after that. A dict maps the
+    flow key to the row, columns grow geometrically.
+
+    Direction is taken from the flow key: inverse column is set when
+    the first packet of the flow was sent to the higher endpoint.
+    """
+
+    def __init__(self, capacity=1024):
+        # flow key: Flow under the threshold
+        self.live = {}
+        self.index = {}
+        self.keys = []
+        self.labels = []
+        self._codes = {}
+
+        self.counts = np.zeros((capacity, COUNTERS), dtype=COUNTS_DTYPE)
+        self.stats = np.zeros((capacity, len(FEATURES) - COUNTERS),
+                              dtype=STATS_DTYPE)
+        self.first = np.zeros(capacity)
+        self.inverse = np.zeros(capacity, dtype=np.bool_)
+        self.apps = np.full(capacity, NO_APP, dtype=np.int16)
+
+    def __len__(self):
+        return len(self.keys) + len(self.live)
+
+    def __contains__(self, key):
+        return key in self.live or key in self.index
+
+    def _grow(self):
+        capacity = len(self.apps) * 2
+        size = len(self.keys)
+
+        for name in ("counts", "stats", "first", "inverse", "apps"):
+            column = getattr(self, name)
+            grown = np.zeros(
+                (capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:size] = column[:size]
+            setattr(self, name, grown)
+
+    def code(self, app):
+        """
+        Code of the application name in the apps column.
+        """
+        if app is None:
+            return NO_APP
+
+        code = self._codes.get(app)
+        if code is None:
+            code = self._codes[app] = len(self.labels)
+            self.labels.append(app)
+
+        return code
+
+    def flow(self, key):
+        """
+        Flow record of the flow under the threshold or None.
+        """
+        return self.live.get(key)
+
+    def row(self, key):
+        """
+        Row of the frozen flow or None.
+        """
+        return self.index.get(key)
+
+    def add(self, key, app, payload, timestamp, ip):
+        """
+        Add a new flow by the first packet.
+
+        Returns:
+            Flow: record of the flow
+        """
+        flow = self.live[key] = Flow(app, payload, timestamp, ip)
+        return flow
+
+    def freeze(self, key):
+        """
+        Move the flow record into the columns.
+
+        Returns:
+            int: row of the flow
+        """
+        flow = self.live.pop(key)
+
+        row = len(self.keys)
+        if row == len(self.apps):
+            self._grow()
+        self.index[key] = row
+        self.keys.append(key)
+
+        features = flow.features()
+        self.counts[row] = features[:COUNTERS]
+        self.stats[row] = features[COUNTERS:]
+        self.first[row] = flow.first_dir
+        self.inverse[row] = flow.origin != key[LOW_IP]
+        self.apps[row] = self.code(flow.app)
+
+        return row
+
+    def count(self, row, payload, ip, packets=1):
+        """
+        Update only counters of the frozen flow. Without math.
+        Payload is the total of all packets counted at once.
+        """
+        counts = self.counts[row]
+
+        if (ip == self.keys[row][LOW_IP]) != self.inverse.item(row):
+            counts[COUNT_DIR] += packets
+            counts[OVERALL_DIR] += payload
+        else:
+            counts[COUNT_BACK] += packets
+            counts[OVERALL_BACK] += payload
+
+    def app(self, key):
+        """
+        Application of the flow or None.
+        """
+        flow = self.live.get(key)
+        if flow is not None:
+            return flow.app
+
+        code = self.apps[self.index[key]]
+        if code == NO_APP:
+            return None
+        return self.labels[code]
+
+    def set_app(self, row, app):
+        self.apps[row] = self.code(app)
+
+    def counters(self, key):
+        """
+        Returns:
+            tuple: (app, count_dir, count_back, overall_dir, overall_back)
+        """
+        flow = self.live.get(key)
+        if flow is not None:
+            return flow.counters()
+
+        return (self.app(key),) + tuple(
+            self.counts[self.index[key]].tolist())
+
+    def export(self, keys=None):
+        """
+        Features and application of the flows, flows under the
+        threshold are frozen first.
+
+        Args:
+            keys: flows to export, all flows by default
+        Returns:
+            list: (features, app), features are python values the same
+                types as Flow.features() has
+        """
+        if keys is None:
+            for key in self.live.keys():
+                self.freeze(key)
+            rows = slice(0, len(self.keys))
+        else:
+            rows = [self.index[key] if key in self.index
+                    else self.freeze(key) for key in keys]
+
+        counts = self.counts[rows].tolist()
+        stats = self.stats[rows].tolist()
+        labels = self.labels + [None]
+        apps = [labels[i] for i in self.apps[rows].tolist()]
+
+        result = []
+        for counters, values, app in zip(counts, stats, apps):
+            for i in INTEGER_STATS:
+                values[i] = int(values[i])
+            result.append((counters + values, app))
+
+        return result
+
+    def remove(self, key):
+        """
+        Remove the flow. The last row takes place of the frozen one.
+        """
+        if self.live.pop(key, None) is not None:
+            return
+
+        row = self.index.pop(key)
+        last = len(self.keys) - 1
+
+        if row != last:
+            moved = self.keys[last]
+            self.keys[row] = moved
+            self.index[moved] = row
+
+            self.counts[row] = self.counts[last]
+            self.stats[row] = self.stats[last]
+            self.first[row] = self.first[last]
+            self.inverse[row] = self.inverse[last]
+            self.apps[row] = self.apps[last]
+
+        self.keys.pop()
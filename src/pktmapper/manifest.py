@@ -0,0 +1,142 @@
+"""
+Manifest of the processed captures
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from cache import fingerprint
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+VERSION = 1
+
+DONE = "done"
+COMMITTING = "committing"
+
+
+class Manifest(object):
+    """
+    Record of the captures whose flows are in the output.
+
+    Every capture is identified by its fingerprint and the processing
+    parameters. Rows of a capture are appended to the output at once
+    and the manifest keeps the position of the output before and after
+    them ("start" and "end": bytes of CSV or rows of the dataset), so
+    rows of an interrupted commit can be cut off.
+
+    Entries:
+        key: {"file", "fingerprint", "params", "output", "status",
+              "start", "end", "time"}
+    """
+
+    def __init__(self, path, output):
+        """
+        Args:
+            path: manifest file
+            output: the output it describes
+        """
+        self.path = path
+        # The same output is found by a relative path from another
+        # directory too
+        self.output = os.path.abspath(output)
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("version") == VERSION and \
+                    os.path.abspath(data.get("output", "")) == self.output:
+                self.entries = data["entries"]
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as f:
+            json.dump({
+                "version": VERSION,
+                "output": self.output,
+                "entries": self.entries
+            }, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def key(self, filename, params):
+        """
+        Identity of the capture processed with the parameters.
+
+        Returns:
+            tuple: (key, fingerprint)
+        """
+        fp = fingerprint(filename)
+        digest = hashlib.sha1(fp)
+        digest.update(json.dumps(params, sort_keys=True))
+        return digest.hexdigest(), fp
+
+    def done(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry["status"] == DONE
+
+    def recover(self, size):
+        """
+        Forget interrupted commits.
+
+        Args:
+            size: current position of the end of the output
+        Returns:
+            int: position the output has to be cut to, or None if
+                the output can be left as is
+        """
+        interrupted = [v["start"] for v in self.entries.values()
+                       if v["status"] != DONE]
+        if interrupted:
+            # Everything after the interrupted commit is dropped
+            end = min(interrupted)
+            self.entries = dict(
+                (k, v) for k, v in self.entries.items()
+                if v["status"] == DONE and v["end"] <= end
+            )
+        elif self.entries:
+            end = max(i["end"] for i in self.entries.values())
+        else:
+            end = None
+
+        if end is not None and size < end:
+            # The output was replaced, the manifest is stale
+            self.entries = {}
+            end = None
+
+        self._save()
+        return end
+
+    def begin(self, key, filename, fp, params, start):
+        """
+        Rows of the capture are about to be appended at start.
+        """
+        self.entries[key] = {
+            "file": os.path.abspath(filename),
+            "fingerprint": fp,
+            "params": params,
+            "output": self.output,
+            "status": COMMITTING,
+            "start": start,
+            "end": start,
+            "time": time.time()
+        }
+        self._save()
+
+    def finish(self, key, end):
+        """
+        All rows of the capture are in the output up to end.
+        """
+        entry = self.entries[key]
+        entry["status"] = DONE
+        entry["end"] = end
+        entry["time"] = time.time()
+        self._save()
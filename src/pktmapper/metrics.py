@@ -6,7 +6,9 @@ Package: PACKET-MAPPER
 Author: Sapunov Nikita <kiton1994@gmail.com>
 """
 
+from flow import FEATURES
 from sklearn import metrics
+import dataset
 import logging
 import os
 import pandas as pd
@@ -30,12 +32,21 @@ def load_data(path):
     Load and split imput data on features and target class (X and y).
 
     Args:
-        path: path to the data
+        path: path to the data. CSV file or directory of the binary
+            dataset (see pktmapper.dataset), which is memory mapped.
     Returns:
         tuple: features and target class (pandas DataFrame)
     """
     if not os.path.exists(path):
         raise FileNotFound(path)
+
+    if dataset.is_dataset(path):
+        features, labels, classes = dataset.load(path)
+        x = pd.DataFrame(features, columns=list(FEATURES), copy=False)
+        y = pd.Series(
+            pd.Categorical.from_codes(labels, classes), name="application")
+        return x, y
+
     data = pd.read_csv(path)
 
     cols = data.columns.tolist()
@@ -0,0 +1,124 @@
+"""
+Mergeable flows of a part of the capture
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from flowtable import HIGH_IP
+from flowtable import LOW_IP
+
+
+class Partial(object):
+    """
+    Flows seen in a contiguous part of the capture, or in the whole
+    capture before its labels are known.
+
+    Only the first threshold packets of a flow contribute to the
+    statistics, so they are kept as is: (timestamp, payload, ip).
+    Packets over the threshold are only counted towards the endpoint
+    of the key they were sent to, or not at all without volume.
+    Partials of consecutive parts are merged exactly and labeled flows
+    are replayed into a FlowTable, which gives the same result as
+    processing the whole capture packet by packet.
+    """
+
+    def __init__(self, threshold, volume=True):
+        self.threshold = threshold
+        self.volume = volume
+        # flow keys in the order of the first packet
+        self.keys = []
+        self.packets = {}
+        # flow key: [packets, payload] to the low endpoint,
+        # [packets, payload] to the high one
+        self.counters = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, payload, timestamp, ip):
+        """
+        Register a packet of the flow.
+        """
+        packets = self.packets.get(key)
+        if packets is None:
+            self.keys.append(key)
+            self.packets[key] = [(timestamp, payload, ip)]
+        elif len(packets) < self.threshold:
+            packets.append((timestamp, payload, ip))
+        elif self.volume:
+            self._count(key, 1, payload, ip)
+
+    def _count(self, key, packets, payload, ip):
+        counters = self.counters.get(key)
+        if counters is None:
+            counters = self.counters[key] = [0, 0, 0, 0]
+
+        if ip == key[LOW_IP]:
+            counters[0] += packets
+            counters[1] += payload
+        else:
+            counters[2] += packets
+            counters[3] += payload
+
+    def merge(self, other):
+        """
+        Append the partial of the next part of the capture.
+
+        Returns:
+            Partial: self
+        """
+        for key in other.keys:
+            packets = self.packets.get(key)
+            tail = other.packets[key]
+            if packets is None:
+                self.keys.append(key)
+                self.packets[key] = tail
+                continue
+
+            room = max(self.threshold - len(packets), 0)
+            packets.extend(tail[:room])
+            if not self.volume:
+                continue
+            for timestamp, payload, ip in tail[room:]:
+                self._count(key, 1, payload, ip)
+
+        for key, counters in other.counters.iteritems():
+            if counters[0]:
+                self._count(key, counters[0], counters[1], key[LOW_IP])
+            if counters[2]:
+                self._count(key, counters[2], counters[3], key[HIGH_IP])
+
+        return self
+
+    def replay(self, table, labels):
+        """
+        Add the labeled flows to the table.
+
+        Args:
+            table: FlowTable
+            labels: dict with flow key and name of the application
+        """
+        for key in self.keys:
+            app = labels.get(key)
+            if app is None:
+                continue
+
+            packets = iter(self.packets[key])
+            timestamp, payload, ip = next(packets)
+            flow = table.add(key, app, payload, timestamp, ip)
+            for timestamp, payload, ip in packets:
+                flow.update(payload, timestamp, ip)
+
+            if len(self.packets[key]) < self.threshold:
+                continue
+            row = table.freeze(key)
+
+            counters = self.counters.get(key)
+            if counters is not None:
+                if counters[0]:
+                    table.count(row, counters[1], key[LOW_IP], counters[0])
+                if counters[2]:
+                    table.count(row, counters[3], key[HIGH_IP], counters[2])
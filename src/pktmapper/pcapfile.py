@@ -0,0 +1,659 @@
+"""
+Memory mapped pcap/pcapng reader
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+import Queue
+import array
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import subprocess
+import threading
+import time
+
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NANO = 0xa1b23c4d
+PCAP_HDR_LEN = 24
+PCAP_REC_LEN = 16
+
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_OPB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BOM = 0x1a2b3c4d
+
+# Options of the interface description block
+IF_TSRESOL = 9
+IF_TSOFFSET = 14
+
+# (resolution, offset, snaplen) of the unknown interface
+_DEFAULT_INTERFACE = (1e-6, 0, 0)
+
+# Consecutive valid record headers which confirm a record boundary
+# found in the middle of the classic pcap file
+SYNC_RECORDS = 8
+# Maximum gap between timestamps of consecutive records, seconds
+SYNC_GAP = 86400
+MAX_SNAPLEN = 262144
+
+# Decompressors of the compressed captures by extension. They run as
+# separate processes and write the capture to stdout.
+DECOMPRESSORS = {
+    ".gz": ("gzip", "-dc"),
+    ".xz": ("xz", "-dc"),
+    ".zst": ("zstd", "-dc")
+}
+# Decompressed data is passed to the parser in chunks through a queue
+# of at most STREAM_BUFFERS chunks
+STREAM_CHUNK = 1 << 20
+STREAM_BUFFERS = 16
+# Seconds to wait for the reader of the tee pipe
+TEE_TIMEOUT = 30
+
+
+class FormatError(Exception):
+    def __init__(self, filename):
+        Exception.__init__(self, filename)
+
+
+class Reader(object):
+    """
+    Classic pcap (both byte orders, micro and nanosecond timestamps)
+    and pcapng reader. The file is memory mapped and packets are
+    yielded as (timestamp, buffer) where buffer points into the map,
+    so nothing is copied. origlen is the length of the last yielded
+    packet on the wire, as the record header has it.
+
+    Usage:
+        with Reader(filename) as pcap:
+            for timestamp, data in pcap:
+                ...
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.position = 0
+        self.origlen = 0
+        self._index = None
+        self._states = {}
+
+        self._file = open(filename, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size < PCAP_REC_LEN:
+            self._file.close()
+            raise FormatError(filename)
+
+        self.data = mmap.mmap(
+            self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic = self.data[:4]
+        if struct.unpack("<I", magic)[0] == PCAPNG_SHB:
+            self._records = self._pcapng
+        else:
+            self._records = self._pcap
+            for endian in ("<", ">"):
+                value, = struct.unpack(endian + "I", magic)
+                if value in (PCAP_MAGIC, PCAP_MAGIC_NANO):
+                    self._endian = endian
+                    self._scale = 1e-9 if value == PCAP_MAGIC_NANO else 1e-6
+                    self._snaplen, = struct.unpack_from(
+                        endian + "I", self.data, 16)
+                    break
+            else:
+                self.close()
+                raise FormatError(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        data = self.data
+        for timestamp, offset, length in self._records():
+            yield timestamp, buffer(data, offset, length)
+
+    def split(self, parts):
+        """
+        Split the file into contiguous byte ranges on record boundaries.
+
+        Classic pcap is resynchronized on the record header found near
+        every boundary. Pcapng blocks are walked once, because records
+        in the middle of the file depend on the interfaces defined
+        before them.
+
+        Returns:
+            list: (start, stop, state) for part(). Ranges cover the
+                whole file, some of them are dropped if records are
+                too large for so many parts.
+        """
+        marks = [self.size * i // parts for i in range(1, parts)]
+
+        if self._records == self._pcapng:
+            self._states = {}
+            for record in self._pcapng(marks=marks):
+                pass
+            bounds = sorted(self._states)
+        else:
+            bounds = [self._sync(mark) for mark in marks]
+
+        bounds = sorted(set([0] + [i for i in bounds if i < self.size]))
+        bounds.append(self.size)
+
+        return [
+            (start, stop, self._states.get(start))
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def part(self, start, stop, state=None):
+        """
+        Packets of the records which start in the byte range made by
+        split(). Yields (timestamp, buffer) as iteration over the file.
+        """
+        data = self.data
+        if self._records == self._pcapng:
+            records = self._pcapng(start, stop, state)
+        else:
+            records = self._pcap(start, stop)
+
+        for timestamp, offset, length in records:
+            yield timestamp, buffer(data, offset, length)
+
+    def _sync(self, offset):
+        """
+        First record boundary of the classic pcap at or after offset.
+        """
+        for offset in xrange(max(offset, PCAP_HDR_LEN), self.size):
+            if self._chain(offset):
+                # When caplen == origlen the chain shifted by a field of
+                # the header looks valid too, the real one starts earlier
+                for back in (12, 8, 4):
+                    if (offset - back >= PCAP_HDR_LEN and
+                            self._chain(offset - back)):
+                        return offset - back
+                return offset
+
+        return self.size
+
+    def _chain(self, offset):
+        """
+        Do valid record headers follow each other from the offset.
+        """
+        data = self.data
+        size = self.size
+        header = struct.Struct(self._endian + "IIII")
+        snaplen = self._snaplen or MAX_SNAPLEN
+        frac_limit = 10 ** 9 if self._scale == 1e-9 else 10 ** 6
+        # capture doesn't go back far from its first record
+        first, = struct.unpack_from(self._endian + "I", data, PCAP_HDR_LEN)
+        previous = None
+
+        for _ in range(SYNC_RECORDS):
+            if offset == size:
+                return True
+            if offset + PCAP_REC_LEN > size:
+                return False
+
+            sec, frac, caplen, origlen = header.unpack_from(data, offset)
+            if (caplen > snaplen or caplen > origlen or
+                    origlen > max(snaplen, MAX_SNAPLEN) or
+                    frac >= frac_limit):
+                return False
+            if sec + SYNC_GAP < first:
+                return False
+            if previous is not None and abs(sec - previous) > SYNC_GAP:
+                return False
+
+            previous = sec
+            offset += PCAP_REC_LEN + caplen
+
+        return offset <= size
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+
+    def index(self):
+        """
+        Scan only the record headers. The result is cached.
+
+        Returns:
+            tuple: (timestamps, offsets, lengths) arrays of records
+                in the file. Data of the record i starts at offsets[i].
+        """
+        if self._index is not None:
+            return self._index
+
+        timestamps = array.array("d")
+        offsets = array.array("l")
+        lengths = array.array("l")
+
+        for timestamp, offset, length in self._records():
+            timestamps.append(timestamp)
+            offsets.append(offset)
+            lengths.append(length)
+
+        self._index = (timestamps, offsets, lengths)
+        return self._index
+
+    def _pcap(self, start=0, stop=None):
+        """
+        Records of the classic pcap file: (timestamp, offset, length)
+        """
+        data = self.data
+        size = self.size
+        scale = self._scale
+        header = struct.Struct(self._endian + "IIII")
+        if stop is None:
+            stop = size
+
+        offset = max(start, PCAP_HDR_LEN)
+        while offset + PCAP_REC_LEN <= size and offset < stop:
+            sec, frac, caplen, origlen = header.unpack_from(data, offset)
+            offset += PCAP_REC_LEN
+            if offset + caplen > size:
+                # truncated file
+                break
+
+            self.position = offset + caplen
+            self.origlen = origlen
+            yield sec + frac * scale, offset, caplen
+            offset += caplen
+
+        self.position = min(stop, size)
+
+    def _pcapng(self, start=0, stop=None, state=None, marks=None):
+        """
+        Records of the pcapng file: (timestamp, offset, length)
+        Simple packet blocks have no timestamp, the previous one is used.
+
+        Args:
+            start, stop, state: byte range and its state made by split()
+            marks: sorted offsets. State at the first block after every
+                mark is saved to self._states.
+        """
+        data = self.data
+        size = self.size
+        if stop is None:
+            stop = size
+        if state is None:
+            # (resolution, offset, snaplen) of every interface of the section
+            endian, interfaces, timestamp = "<", [], 0.0
+        else:
+            endian, interfaces, timestamp = state
+            interfaces = list(interfaces)
+
+        offset = start
+        while offset + 12 <= size and offset < stop:
+            if marks and offset >= marks[0]:
+                self._states[offset] = (endian, tuple(interfaces), timestamp)
+                while marks and offset >= marks[0]:
+                    marks.pop(0)
+
+            btype, = struct.unpack_from(endian + "I", data, offset)
+            if btype == PCAPNG_SHB:
+                bom, = struct.unpack_from("<I", data, offset + 8)
+                endian = "<" if bom == PCAPNG_BOM else ">"
+                interfaces = []
+
+            blen, = struct.unpack_from(endian + "I", data, offset + 4)
+            if blen < 12 or offset + blen > size:
+                # corrupted or truncated file
+                break
+
+            if btype == PCAPNG_EPB:
+                iface, high, low, caplen, origlen = struct.unpack_from(
+                    endian + "IIIII", data, offset + 8)
+                if iface < len(interfaces):
+                    resolution, tsoffset, snaplen = interfaces[iface]
+                else:
+                    resolution, tsoffset, snaplen = _DEFAULT_INTERFACE
+                timestamp = ((high << 32) | low) * resolution + tsoffset
+
+                self.position = offset + blen
+                self.origlen = origlen
+                yield timestamp, offset + 28, caplen
+
+            elif btype == PCAPNG_SPB:
+                origlen, = struct.unpack_from(endian + "I", data, offset + 8)
+                caplen = min(origlen, blen - 16)
+                if interfaces and interfaces[0][2]:
+                    caplen = min(caplen, interfaces[0][2])
+
+                self.position = offset + blen
+                self.origlen = origlen
+                yield timestamp, offset + 12, caplen
+
+            elif btype == PCAPNG_OPB:
+                iface, drops, high, low, caplen, origlen = \
+                    struct.unpack_from(endian + "HHIIII", data, offset + 8)
+                if iface < len(interfaces):
+                    resolution, tsoffset, snaplen = interfaces[iface]
+                else:
+                    resolution, tsoffset, snaplen = _DEFAULT_INTERFACE
+                timestamp = ((high << 32) | low) * resolution + tsoffset
+
+                self.position = offset + blen
+                self.origlen = origlen
+                yield timestamp, offset + 28, caplen
+
+            elif btype == PCAPNG_IDB:
+                interfaces.append(
+                    _interface(data, endian, offset + 8, offset + blen - 4))
+
+            offset += blen
+
+        self.position = min(stop, size)
+
+
+def _interface(data, endian, start, stop):
+    """
+    Parse the body of the pcapng interface description block.
+
+    Returns:
+        tuple: (resolution, offset, snaplen)
+    """
+    linktype, snaplen = struct.unpack_from(endian + "H2xI", data, start)
+    resolution = 1e-6
+    tsoffset = 0
+
+    option = start + 8
+    while option + 4 <= stop:
+        code, length = struct.unpack_from(endian + "HH", data, option)
+        if code == 0:
+            break
+
+        if code == IF_TSRESOL and length >= 1:
+            value = ord(data[option + 4])
+            if value & 0x80:
+                resolution = 2.0 ** -(value & 0x7f)
+            else:
+                resolution = 10.0 ** -value
+        elif code == IF_TSOFFSET and length >= 8:
+            tsoffset, = struct.unpack_from(endian + "q", data, option + 4)
+
+        # options are padded to 32 bits
+        option += 4 + ((length + 3) & ~3)
+
+    return resolution, tsoffset, snaplen
+
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1] in DECOMPRESSORS
+
+
+def open_capture(filename, tee=None):
+    """
+    Reader of the capture: memory mapped for plain files and streaming
+    for compressed ones.
+
+    Args:
+        tee: named pipe which gets a copy of the decompressed capture
+    """
+    if is_compressed(filename):
+        return StreamReader(filename, tee)
+    return Reader(filename)
+
+
+def _open_fifo(path):
+    """
+    Open the named pipe for writing once its reader is there.
+
+    Returns:
+        file: or None if nobody opened the pipe in TEE_TIMEOUT seconds
+    """
+    deadline = time.time() + TEE_TIMEOUT
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO or time.time() > deadline:
+                return None
+            time.sleep(0.01)
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+    return os.fdopen(fd, "wb")
+
+
+class StreamReader(object):
+    """
+    Sequential reader of the compressed capture, classic pcap or
+    pcapng. The decompressor runs as a separate process, a thread
+    passes its output to the parser through a bounded queue, so
+    decompression and parsing overlap and nothing is written to disk.
+
+    It has the interface of Reader for sequential processing:
+    iteration, origlen, filename, size and position, which are counted
+    in bytes of the compressed file. Packets are yielded as str.
+    """
+
+    def __init__(self, filename, tee=None):
+        """
+        Args:
+            filename: compressed capture
+            tee: named pipe which gets a copy of the decompressed data.
+                The reader fails with IOError if nobody opens it in
+                TEE_TIMEOUT seconds.
+        """
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.closed = False
+        self.origlen = 0
+
+        dnull = open(os.devnull, "w")
+        try:
+            # The decompressor shares the file offset with us, it gives
+            # the position
+            self._proc = subprocess.Popen(
+                DECOMPRESSORS[os.path.splitext(filename)[1]],
+                stdin=self._file, stdout=subprocess.PIPE, stderr=dnull)
+        finally:
+            dnull.close()
+
+        self._chunks = Queue.Queue(STREAM_BUFFERS)
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        # Error of the feeder, raised by the parser
+        self._error = None
+
+        self._feeder = threading.Thread(target=self._feed, args=(tee,))
+        self._feeder.daemon = True
+        self._feeder.start()
+
+        try:
+            valid = self._fill(4)
+        except IOError:
+            self.close()
+            raise
+        if not valid:
+            self.close()
+            raise FormatError(filename)
+        self._magic = self._buf[:4]
+        if struct.unpack("<I", self._magic)[0] != PCAPNG_SHB:
+            for endian in ("<", ">"):
+                if struct.unpack(endian + "I", self._magic)[0] in (
+                        PCAP_MAGIC, PCAP_MAGIC_NANO):
+                    break
+            else:
+                self.close()
+                raise FormatError(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def position(self):
+        if self.closed:
+            return self.size
+        return min(os.lseek(self._file.fileno(), 0, os.SEEK_CUR), self.size)
+
+    def _put(self, chunk):
+        while not self.closed:
+            try:
+                self._chunks.put(chunk, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _feed(self, tee):
+        out = None
+        if tee is not None:
+            out = _open_fifo(tee)
+            if out is None:
+                # The reader of the tee would wait for data forever
+                self._error = IOError(
+                    "Nobody opened the tee of {0} in {1} s".format(
+                        self.filename, TEE_TIMEOUT))
+                self._put("")
+                return
+
+        try:
+            while True:
+                chunk = self._proc.stdout.read(STREAM_CHUNK)
+                if out is not None:
+                    try:
+                        out.write(chunk)
+                    except IOError:
+                        # the reader of the tee is gone
+                        out = None
+                if not chunk or not self._put(chunk):
+                    break
+        finally:
+            if out is not None:
+                try:
+                    out.close()
+                except IOError:
+                    pass
+            self._put("")
+
+    def _fill(self, size):
+        """
+        Make size bytes available in the buffer from _pos.
+
+        Returns:
+            bool: False at the end of the stream
+        """
+        while len(self._buf) - self._pos < size:
+            if self._eof:
+                return False
+            chunk = self._chunks.get()
+            if not chunk:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+                if self._proc.wait() != 0:
+                    raise IOError(
+                        "Can't decompress {0}".format(self.filename))
+                return False
+            self._buf = self._buf[self._pos:] + chunk
+            self._pos = 0
+
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        self._feeder.join()
+        self._proc.stdout.close()
+        self._file.close()
+
+    def __iter__(self):
+        if struct.unpack("<I", self._magic)[0] == PCAPNG_SHB:
+            return self._pcapng()
+        return self._pcap()
+
+    def _pcap(self):
+        if not self._fill(PCAP_HDR_LEN):
+            return
+
+        for endian in ("<", ">"):
+            value, = struct.unpack(endian + "I", self._magic)
+            if value in (PCAP_MAGIC, PCAP_MAGIC_NANO):
+                break
+        scale = 1e-9 if value == PCAP_MAGIC_NANO else 1e-6
+        header = struct.Struct(endian + "IIII")
+        self._pos += PCAP_HDR_LEN
+
+        while self._fill(PCAP_REC_LEN):
+            sec, frac, caplen, origlen = header.unpack_from(
+                self._buf, self._pos)
+            if not self._fill(PCAP_REC_LEN + caplen):
+                # truncated file
+                break
+
+            start = self._pos + PCAP_REC_LEN
+            self._pos = start + caplen
+            self.origlen = origlen
+            yield sec + frac * scale, self._buf[start:self._pos]
+
+    def _pcapng(self):
+        endian = "<"
+        interfaces = []
+        timestamp = 0.0
+
+        while self._fill(12):
+            btype, = struct.unpack_from(endian + "I", self._buf, self._pos)
+            if btype == PCAPNG_SHB:
+                bom, = struct.unpack_from("<I", self._buf, self._pos + 8)
+                endian = "<" if bom == PCAPNG_BOM else ">"
+                interfaces = []
+
+            blen, = struct.unpack_from(endian + "I", self._buf, self._pos + 4)
+            if blen < 12 or not self._fill(blen):
+                # corrupted or truncated file
+                break
+            data = self._buf
+            offset = self._pos
+            self._pos += blen
+
+            if btype in (PCAPNG_EPB, PCAPNG_OPB):
+                if btype == PCAPNG_EPB:
+                    iface, high, low, caplen, origlen = struct.unpack_from(
+                        endian + "IIIII", data, offset + 8)
+                else:
+                    iface, drops, high, low, caplen, origlen = \
+                        struct.unpack_from(endian + "HHIIII", data, offset + 8)
+                if iface < len(interfaces):
+                    resolution, tsoffset, snaplen = interfaces[iface]
+                else:
+                    resolution, tsoffset, snaplen = _DEFAULT_INTERFACE
+                timestamp = ((high << 32) | low) * resolution + tsoffset
+
+                self.origlen = origlen
+                yield timestamp, data[offset + 28:offset + 28 + caplen]
+
+            elif btype == PCAPNG_SPB:
+                origlen, = struct.unpack_from(endian + "I", data, offset + 8)
+                caplen = min(origlen, blen - 16)
+                if interfaces and interfaces[0][2]:
+                    caplen = min(caplen, interfaces[0][2])
+
+                self.origlen = origlen
+                yield timestamp, data[offset + 12:offset + 12 + caplen]
+
+            elif btype == PCAPNG_IDB:
+                interfaces.append(
+                    _interface(data, endian, offset + 8, offset + blen - 4))
@@ -7,408 +7,495 @@ Author: Sapunov Nikita <kiton1994@gmail.com>
 """
 
 
-from common import ip2long
-from common import ip2str
+from common import str2ip
 from dpkt.tcp import TCP
 from dpkt.udp import UDP
-from hashlib import md5
+
+from StringIO import StringIO
 
 import dpkt
+import fcntl
 import json
 import os
+import re
+import shutil
+import signal
+import struct
 import subprocess
 import tempfile
-
-
-def flow_hash(ip_a, ip_b, port_a, port_b, proto):
+import threading
+
+
+PROTOCOLS = {
+    dpkt.ip.IP_PROTO_TCP: "tcp",
+    dpkt.ip.IP_PROTO_UDP: "udp"
+}
+
+ETH_TYPE_OFFSET = 12
+ETH_TYPE_VLAN = (
+    dpkt.ethernet.ETH_TYPE_8021Q,
+    0x88a8,  # IEEE 802.1ad QinQ
+    0x9100   # legacy QinQ
+)
+VLAN_TAG_LEN = 4
+UDP_HDR_LEN = 8
+
+# ip_a, port_a, ip_b, port_b, proto
+_FLOW_KEY = struct.Struct("!4sH4sHB")
+
+_ETH_TYPE = struct.Struct("!H")
+# v_hl, len, flags + offset, proto, src, dst
+_IP_HDR = struct.Struct("!BxH2xHxB2x4s4s")
+# len, flags + offset, proto
+_PLAIN_IP_HDR = struct.Struct("!2xH2xHxB")
+# sport, dport, off_x2
+_TCP_HDR = struct.Struct("!HH8xB")
+# sport, dport
+_UDP_HDR = struct.Struct("!HH")
+
+# Ethernet type, IP version and header length of untagged IPv4 frames
+# without IP options, their addresses and ports are at fixed offsets
+PLAIN_IPV4 = "\x08\x00\x45"
+PLAIN_IPV4_AT = slice(ETH_TYPE_OFFSET, ETH_TYPE_OFFSET + 3)
+# src ip, dst ip, src port, dst port of such frames
+PLAIN_HEADERS = slice(26, 38)
+PLAIN_IP = ETH_TYPE_OFFSET + 2
+PLAIN_TRANSPORT = PLAIN_IP + 20
+
+# Bytes read from the nDPI pipe at once
+NDPI_CHUNK = 65536
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NUMBER_CHARS = "0123456789.eE+-"
+
+
+def flow_key(ip_a, ip_b, port_a, port_b, proto):
     """
-    Creates specific hash that determines uniq flow.
-    Ip addresses always sort ASC.
+    Creates specific key that determines uniq flow.
+    Endpoints always sort ASC, so both directions of the flow
+    share the same key.
 
     Args:
-        ip_a: source ip address
-        ip_b: destination ip address
+        ip_a: source ip address (4 raw bytes)
+        ip_b: destination ip address (4 raw bytes)
         port_a: source port
         port_b: destination port
-        proto: protocol of the transport layer
+        proto: protocol number of the transport layer
     Returns:
-        str: hash value
+        str: 13 bytes key value
     """
-    a = ip2long(ip_a)
-    b = ip2long(ip_b)
-    hsh = ""
+    # Minimal endpoint first
+    if (ip_a, port_a) > (ip_b, port_b):
+        return _FLOW_KEY.pack(ip_b, port_b, ip_a, port_a, proto)
 
-    # Minimal ip address first
-    if a > b:
-        hsh = ip_b
-    else:
-        hsh = ip_a
+    return _FLOW_KEY.pack(ip_a, port_a, ip_b, port_b, proto)
 
-    hsh += str(port_a + port_b)
-    hsh += proto.lower()
 
-    return md5(hsh).hexdigest()
-
-
-def _process_ndpijson(json_raw):
+def raw_keys(flows):
     """
-    Precess json file from nDPI to self.DPI dictionary
-    with md5 key and name of the application as a value.
+    Header bytes of the flows as they are in the frames.
+    A frame with data[PLAIN_IPV4_AT] == PLAIN_IPV4 whose
+    data[PLAIN_HEADERS] isn't in the set belongs to none of the flows
+    and can be dropped before decoding. Protocol isn't a part of the
+    raw key, so the frames which pass still have to be checked with
+    flow_key.
+
+    Args:
+        flows: iterable of flow keys
+    Returns:
+        frozenset: 12 bytes strings for both directions of every flow
     """
-    jon = json.loads(json_raw)
-    dpi = {"general": {}, "flows": {}}
-    protos = ("TCP", "UDP")
+    keys = set()
+    for fid in flows:
+        keys.update(raw_headers(fid))
 
-    for key, value in jon.items():
-        if key == "detected.protos":
-            pkts = 0
-            byts = 0
-            flws = 0
-            for i in value:
-                if i["name"] == "Unknown":
-                    dpi["general"].update(
-                        {"unknown": (
-                            i["packets"], i["bytes"], i["flows"]
-                        )}
-                    )
-                else:
-                    pkts += i["packets"]
-                    byts += i["bytes"]
-                    flws += i["flows"]
-            dpi["general"].update({"known": (pkts, byts, flws)})
+    return frozenset(keys)
 
-        elif key == "known.flows":
-            for i in value:
-                if i["protocol"] in protos:
-                    fid = flow_hash(
-                        i["host_a.name"],
-                        i["host_b.name"],
-                        i["host_a.port"],
-                        i["host_b.port"],
-                        i["protocol"]
-                    )
-
-                    name = i["detected.protocol.name"].split(".")[0]
-                    dpi["flows"].update(
-                        {fid: name}
-                    )
-    return dpi
 
+def raw_headers(fid):
+    """
+    Header bytes of the flow in the frames, see raw_keys.
 
-def ndpi_processing(filename):
+    Returns:
+        tuple: (to the high endpoint, to the low endpoint) 12 bytes
     """
-    Filling self.DPI dict with data from nDPI.
+    ip_a, port_a, ip_b, port_b = fid[:4], fid[4:6], fid[6:10], fid[10:12]
+    return ip_a + ip_b + port_a + port_b, ip_b + ip_a + port_b + port_a
+
+
+class _JsonStream(object):
     """
-    tmp_file = tempfile.mktemp()
+    Incremental reader of a JSON object from a file-like stream.
 
-    cmd = ["ndpiReader", "-i", filename, "-v", "1", "-j", tmp_file]
+    Members of the top level object are yielded one by one. Arrays are
+    not kept in memory: their elements are yielded as soon as they are
+    read, so memory is bounded by the size of one element.
+    """
+
+    def __init__(self, stream, size=NDPI_CHUNK):
+        self.stream = stream
+        self.size = size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        """
+        Read the next chunk. Consumed part of the buffer is dropped.
+        """
+        chunk = self.stream.read(self.size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """
+        Next significant character. It isn't consumed.
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Unexpected end of JSON")
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError(
+                "Expected {0} at {1}, got {2}".format(chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def _value(self):
+        """
+        Decode the next value. The value is accepted only if a delimiter
+        follows it, otherwise a number could be cut by the chunk border.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+                if self.eof or (end < len(self.buf) and
+                                self.buf[end] not in _NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._more()
+
+    def members(self):
+        """
+        Yields:
+            tuple: (key, value) of the top level members. For arrays
+                (key, element) is yielded for every element.
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            return
+
+        while True:
+            key = self._value()
+            self._expect(":")
+
+            if self._peek() == "[":
+                self.pos += 1
+                if self._peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield key, self._value()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                yield key, self._value()
+
+            if self._expect(",}") == "}":
+                return
 
-    dnull = open(os.devnull, 'w')
-    proc = subprocess.Popen(cmd, stdout=dnull)
-    dnull.close()
-    proc.wait()
 
-    with open(tmp_file) as jon:
-        dpi = _process_ndpijson(jon.read())
+def _process_ndpistream(stream):
+    """
+    Precess json output of nDPI to self.DPI dictionary
+    with flow key and name of the application as a value.
 
-    os.remove(tmp_file)
+    Flows are read one by one, the document isn't loaded as a whole.
+    """
+    dpi = {"general": {}, "flows": {}}
+    protos = {"TCP": dpkt.ip.IP_PROTO_TCP, "UDP": dpkt.ip.IP_PROTO_UDP}
+    # One instance of every application name for all flows
+    names = {}
+    pkts = 0
+    byts = 0
+    flws = 0
+
+    for key, i in _JsonStream(stream).members():
+        if key == "detected.protos":
+            if i["name"] == "Unknown":
+                dpi["general"].update(
+                    {"unknown": (
+                        i["packets"], i["bytes"], i["flows"]
+                    )}
+                )
+            else:
+                pkts += i["packets"]
+                byts += i["bytes"]
+                flws += i["flows"]
 
+        elif key == "known.flows":
+            if i["protocol"] in protos:
+                fid = flow_key(
+                    str2ip(i["host_a.name"]),
+                    str2ip(i["host_b.name"]),
+                    i["host_a.port"],
+                    i["host_b.port"],
+                    protos[i["protocol"]]
+                )
+
+                name = i["detected.protocol.name"].split(".")[0]
+                dpi["flows"][fid] = names.setdefault(name, name)
+
+    dpi["general"].update({"known": (pkts, byts, flws)})
     return dpi
 
 
-def _flow_recalc(fid, payload, timestamp, ip_a, flows):
+def _process_ndpijson(json_raw):
     """
-    Recalculate metrics for each flow.
+    Precess json document from nDPI. See _process_ndpistream.
     """
-    f = flows[fid]
-    direct = bool(ip_a == f[33])
-    #
-    # general metrics
-    #
-    app = f[0]
-    if direct:
-        count_dir = f[1] + 1
-        count_back = f[2]
-
-        overall_dir = f[3] + payload
-        overall_back = f[4]
-    else:
-        count_dir = f[1]
-        count_back = f[2] + 1
-
-        overall_dir = f[3]
-        overall_back = f[4] + payload
-    #
-    # inter arrival time
-    #
-    if direct:
-        if count_dir >= 2:
-            _itime = timestamp - f[29]
-        else:
-            _itime = 0
+    return _process_ndpistream(StringIO(json_raw))
 
-        # intermediate values
-        _overall_itime_dir = f[31] + _itime
-        _overall_itime_back = f[32]
 
-        max_itime_back = f[6]
-        if count_dir == 2:
-            max_itime_dir = _itime
-            min_itime_dir = _itime
-        else:
-            max_itime_dir = max([_itime, f[5]])
-            min_itime_dir = min([_itime, f[7]])
-        min_itime_back = f[8]
+def _sigint():
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-        avg_itime_dir = _overall_itime_dir / count_dir
-        avg_itime_back = f[10]
 
-        # intermediate value
-        _std_itime_dir = (_itime - avg_itime_dir) ** 2
-        _std_itime_back = f[26]
+def ndpi_start(filename):
+    """
+    Run nDPI on the file in background. Its json output is written
+    to a named pipe, so nothing is stored on disk.
 
-        std_itime_dir = (_std_itime_dir / count_dir) ** 0.5
-        std_itime_back = f[12]
+    Returns:
+        tuple: handle for ndpi_collect
+    """
+    tmp_dir = tempfile.mkdtemp()
+    fifo = os.path.join(tmp_dir, "ndpi.json")
+    os.mkfifo(fifo)
 
-        var_itime_dir = max_itime_dir - min_itime_dir
-        var_itime_back = f[14]
-    else:
-        if count_back >= 2:
-            _itime = timestamp - f[30]
-        else:
-            _itime = 0
+    # Our own writer end keeps the pipe open until nDPI exits: reading
+    # doesn't get EOF before nDPI opens the pipe, and it doesn't hang
+    # if nDPI fails without opening it at all.
+    reader = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+    writer = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+    flags = fcntl.fcntl(reader, fcntl.F_GETFL)
+    fcntl.fcntl(reader, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
 
-        # intermediate values
-        _overall_itime_back = f[32] + _itime
-        _overall_itime_dir = f[31]
+    cmd = ["ndpiReader", "-i", filename, "-v", "1", "-j", fifo]
 
-        max_itime_dir = f[5]
-        min_itime_dir = f[7]
-        max_itime_back = max([_itime, f[6]])
-        if count_back == 2:
-            min_itime_back = _itime
-        else:
-            min_itime_back = min([_itime, f[7]])
+    dnull = open(os.devnull, 'w')
+    try:
+        # Ctrl-C stops nDPI even if the caller ignores it
+        proc = subprocess.Popen(cmd, stdout=dnull, preexec_fn=_sigint)
+    except OSError:
+        os.close(reader)
+        os.close(writer)
+        shutil.rmtree(tmp_dir)
+        raise
+    finally:
+        dnull.close()
 
-        avg_itime_dir = f[9]
-        avg_itime_back = _overall_itime_back / count_back
+    def _wait():
+        proc.wait()
+        os.close(writer)
 
-        # intermediate value
-        _std_itime_dir = f[25]
-        _std_itime_back = (_itime - avg_itime_back) ** 2
+    waiter = threading.Thread(target=_wait)
+    waiter.daemon = True
+    waiter.start()
 
-        std_itime_dir = f[11]
-        std_itime_back = (_std_itime_back / count_back) ** 0.5
+    return os.fdopen(reader, "rb"), proc, waiter, tmp_dir
 
-        var_itime_dir = f[13]
-        var_itime_back = max_itime_back - min_itime_back
-    #
-    # payload
-    #
-    if direct:
-        max_payload_dir = max([payload, f[15]])
-        max_payload_back = f[16]
 
-        min_payload_dir = min([payload, f[17]])
-        min_payload_back = f[18]
+def ndpi_collect(handle):
+    """
+    Parse output of nDPI started by ndpi_start while it's produced.
 
-        avg_payload_dir = overall_dir / count_dir
-        avg_payload_back = f[20]
+    Returns:
+        dict: see _process_ndpistream
+    """
+    stream, proc, waiter, tmp_dir = handle
+    try:
+        dpi = _process_ndpistream(stream)
+    finally:
+        stream.close()
+        waiter.join()
+        shutil.rmtree(tmp_dir)
 
-        # intermediate value
-        _std_payload_dir = (payload - avg_payload_dir) ** 2
-        _std_payload_back = f[28]
+    return dpi
 
-        std_payload_dir = (_std_payload_dir / count_dir) ** 0.5
-        std_payload_back = f[22]
 
-        var_payload_dir = max_payload_dir - min_payload_dir
-        var_payload_back = f[24]
-    else:
-        max_payload_dir = f[15]
-        max_payload_back = max([payload, f[16]])
+def ndpi_cancel(handle):
+    """
+    Stop nDPI started by ndpi_start.
+    """
+    stream, proc, waiter, tmp_dir = handle
+    if proc.poll() is None:
+        proc.kill()
+    stream.close()
+    waiter.join()
+    shutil.rmtree(tmp_dir)
 
-        min_payload_dir = f[17]
-        if count_back == 1:
-            min_payload_back = payload
-        else:
-            min_payload_back = min([payload, f[18]])
-
-        avg_payload_dir = f[19]
-        avg_payload_back = overall_back / count_back
-
-        # intermediate value
-        _std_payload_dir = f[27]
-        _std_payload_back = (payload - avg_payload_back) ** 2
-
-        std_payload_dir = f[21]
-        std_payload_back = (_std_payload_back / count_back) ** 0.5
-
-        var_payload_dir = f[23]
-        var_payload_back = max_payload_back - min_payload_back
-    #
-    # intermediate values for calculations
-    #
-    if direct:
-        _current_timestamp_dir = timestamp
-        _current_timestamp_back = f[30]
-    else:
-        _current_timestamp_dir = f[29]
-        _current_timestamp_back = timestamp
-    _last_used_ip = ip_a
-
-    flows[fid] = (
-        app,
-        count_dir,
-        count_back,
-        overall_dir,
-        overall_back,
-        max_itime_dir,
-        max_itime_back,
-        min_itime_dir,
-        min_itime_back,
-        avg_itime_dir,
-        avg_itime_back,
-        std_itime_dir,
-        std_itime_back,
-        var_itime_dir,
-        var_itime_back,
-        max_payload_dir,
-        max_payload_back,
-        min_payload_dir,
-        min_payload_back,
-        avg_payload_dir,
-        avg_payload_back,
-        std_payload_dir,
-        std_payload_back,
-        var_payload_dir,
-        var_payload_back,
-        _std_itime_dir,
-        _std_itime_back,
-        _std_payload_dir,
-        _std_payload_back,
-        _current_timestamp_dir,
-        _current_timestamp_back,
-        _overall_itime_dir,
-        _overall_itime_back,
-        _last_used_ip
-    )
+
+def ndpi_processing(filename):
+    """
+    Filling self.DPI dict with data from nDPI.
+    """
+    return ndpi_collect(ndpi_start(filename))
 
 
 def soft_recalc(fid, payload, ip_a, flows):
     """
     Update only counters. Without math.
     """
-    ip = flows[fid][-1]
-    count_dir = flows[fid][1]
-    count_back = flows[fid][2]
-    overall_dir = flows[fid][3]
-    overall_back = flows[fid][4]
-
-    if ip == ip_a:
-        count_dir += 1
-        overall_dir += payload
-    else:
-        count_back += 1
-        overall_back += payload
-
-    flows[fid] = (
-        flows[fid][0],
-        count_dir,
-        count_back,
-        overall_dir,
-        overall_back
-    ) + flows[fid][5:-1] + (ip_a,)
+    flows.count(flows.row(fid), payload, ip_a)
 
 
 def flow_processing(fid, payload, timestamp, ip_a, flows, app):
     """
     Flow processing.
+
+    Args:
+        flows: FlowTable instance
     """
-    if fid not in flows:
-        flows[fid] = (
-            #
-            # general metrics
-            #
-            app,        # [0]  application
-            1,          # [1]  count_dir
-            0,          # [2]  count_back
-            payload,    # [3]  overall_dir
-            0,          # [4]  overall_back
-            #
-            # inter arrival time
-            #
-            0,          # [5]  max_itime_dir
-            0,          # [6]  max_itime_back
-            0,          # [7]  min_itime_dir
-            0,          # [8]  min_itime_back
-            0,          # [9]  avg_itime_dir
-            0,          # [10] avg_itime_back
-            0,          # [11] std_itime_dir
-            0,          # [12] std_itime_back
-            0,          # [13] var_itime_dir
-            0,          # [14] var_itime_back
-            #
-            # payload
-            #
-            payload,    # [15] max_payload_dir
-            0,          # [16] max_payload_back
-            payload,    # [17] min_payload_dir
-            0,          # [18] min_payload_back
-            payload,    # [19] avg_payload_dir
-            0,          # [20] avg_payload_back
-            0,          # [21] std_payload_dir
-            0,          # [22] std_payload_back
-            0,          # [23] var_payload_dir
-            0,          # [24] var_payload_back
-            #
-            # intermediate values for calculations
-            #
-            0,          # [25] _std_itime_dir
-            0,          # [26] _std_itime_back
-            0,          # [27] _std_payload_dir
-            0,          # [28] _std_payload_back
-            timestamp,  # [29] _current_timestamp_dir
-            0,          # [30] _current_timestamp_back
-            0,          # [31] _overall_itime_dir
-            0,          # [32] _overall_itime_back
-            ip_a        # [33] _last_used_ip. For determining dir or back
-        )
+    flow = flows.flow(fid)
+    if flow is None:
+        flows.add(fid, app, payload, timestamp, ip_a)
     else:
-        _flow_recalc(fid, payload, timestamp, ip_a, flows)
+        flow.update(payload, timestamp, ip_a)
 
 
-def packet_data(data):
+def _packet_data_dpkt(data):
     """
-    Common packet processing.
-
-    Args:
-        data - packet content
-    Returns:
-        (transport, ip_a, ip_b, port_a, port_b, payload)
+    Packet processing with the full dpkt decoding.
+    Slow path for the frames which packet_data can't parse by itself.
     """
-    if not data:
+    try:
+        eth = dpkt.ethernet.Ethernet(data)
+    except dpkt.UnpackError:
         return None
 
-    eth = dpkt.ethernet.Ethernet(data)
-    if eth.type != dpkt.ethernet.ETH_TYPE_IP:
+    ip_packet = eth.data
+    if eth.type != dpkt.ethernet.ETH_TYPE_IP or \
+            not isinstance(ip_packet, dpkt.ip.IP):
         return None
 
-    ip_packet = eth.data
     trans_packet = ip_packet.data
 
-    if type(ip_packet.data) == UDP:
-        transport = "udp"
-    elif type(ip_packet.data) == TCP:
-        transport = "tcp"
-    else:
+    if type(trans_packet) not in (UDP, TCP):
         return None
 
     return (
-        transport,
-        ip2str(ip_packet.dst),
-        ip2str(ip_packet.src),
+        ip_packet.p,
+        ip_packet.dst,
+        ip_packet.src,
         trans_packet.dport,
         trans_packet.sport,
         len(trans_packet.data)
     )
+
+
+def plain_payload(data):
+    """
+    Protocol and payload length of the frame which passed the
+    PLAIN_IPV4 test, without decoding the rest of the headers.
+    The result is the same as packet_data gives.
+
+    Args:
+        data - packet content (str or buffer)
+    Returns:
+        (proto, payload) or None if the frame needs packet_data
+    """
+    try:
+        length, frag, proto = _PLAIN_IP_HDR.unpack_from(data, PLAIN_IP)
+        if proto == dpkt.ip.IP_PROTO_TCP:
+            offset = PLAIN_TRANSPORT + \
+                ((ord(data[PLAIN_TRANSPORT + 12]) >> 4) << 2)
+        elif proto == dpkt.ip.IP_PROTO_UDP:
+            offset = PLAIN_TRANSPORT + UDP_HDR_LEN
+        else:
+            return None
+    except (struct.error, IndexError):
+        return None
+
+    if frag & dpkt.ip.IP_OFFMASK:
+        return None
+
+    if length:
+        end = min(PLAIN_IP + length, len(data))
+    else:
+        end = len(data)
+
+    if offset > end:
+        return None
+
+    return proto, end - offset
+
+
+def packet_data(data):
+    """
+    Common packet processing.
+    Header fields are read at fixed offsets without building dpkt objects.
+    802.1Q/QinQ tagged frames are supported.
+
+    Args:
+        data - packet content (str or memoryview)
+    Returns:
+        (proto, ip_a, ip_b, port_a, port_b, payload)
+        Ip addresses are raw 4 bytes strings, proto is a protocol number.
+    """
+    if not data:
+        return None
+
+    try:
+        offset = ETH_TYPE_OFFSET
+        eth_type, = _ETH_TYPE.unpack_from(data, offset)
+        while eth_type in ETH_TYPE_VLAN:
+            offset += VLAN_TAG_LEN
+            eth_type, = _ETH_TYPE.unpack_from(data, offset)
+
+        if eth_type != dpkt.ethernet.ETH_TYPE_IP:
+            return None
+        offset += _ETH_TYPE.size
+
+        v_hl, length, frag, proto, src, dst = _IP_HDR.unpack_from(
+            data, offset)
+        if v_hl >> 4 != 4:
+            return _packet_data_dpkt(data)
+        if proto not in PROTOCOLS or frag & dpkt.ip.IP_OFFMASK:
+            return None
+
+        if length:
+            end = min(offset + length, len(data))
+        else:
+            # very likely due to TCP segmentation offload
+            end = len(data)
+        offset += (v_hl & 0xf) << 2
+
+        if proto == dpkt.ip.IP_PROTO_TCP:
+            sport, dport, off_x2 = _TCP_HDR.unpack_from(data, offset)
+            offset += (off_x2 >> 4) << 2
+        else:
+            sport, dport = _UDP_HDR.unpack_from(data, offset)
+            offset += UDP_HDR_LEN
+    except struct.error:
+        return _packet_data_dpkt(data)
+
+    if offset > end:
+        return _packet_data_dpkt(data)
+
+    return (proto, dst, src, dport, sport, end - offset)
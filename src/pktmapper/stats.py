@@ -0,0 +1,172 @@
+"""
+Streaming statistics
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from bisect import bisect_left
+
+
+class Moments(object):
+    """
+    Running min, max, mean and variance of a stream of values.
+    Uses Welford's update, so every value costs O(1) and the result
+    doesn't suffer from the cancellation of the naive sum of squares.
+    Partial states can be merged (Chan et al.), so one stream may be
+    aggregated in several places and combined afterwards.
+    """
+
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = 0
+        self.max = 0
+
+    def push(self, value):
+        """
+        Add a value to the stream.
+        """
+        self.count += 1
+        if self.count == 1:
+            self.min = value
+            self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """
+        Combine with the state of another part of the stream.
+
+        Args:
+            other: Moments instance
+        Returns:
+            Moments: self
+        """
+        if other.count == 0:
+            return self
+
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean
+            self.m2 = other.m2
+            self.min = other.min
+            self.max = other.max
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.count = count
+
+        return self
+
+    @property
+    def std(self):
+        """
+        Population standard deviation.
+        """
+        if self.count == 0:
+            return 0.0
+        return (self.m2 / self.count) ** 0.5
+
+    @property
+    def range(self):
+        return self.max - self.min
+
+    def __repr__(self):
+        return "Moments(count={0}, mean={1}, std={2}, min={3}, max={4})".format(
+            self.count, self.mean, self.std, self.min, self.max)
+
+
+def exponential_buckets(start, factor, count):
+    """
+    Upper bounds of the buckets: start, start * factor, ...
+    """
+    return [start * factor ** i for i in range(count)]
+
+
+class Histogram(object):
+    """
+    Counts of values in buckets with fixed upper bounds, the same as
+    Prometheus histograms are. A value costs a bisect over the bounds
+    and memory doesn't depend on the number of values.
+
+    Every histogram is expected to be updated by one thread, readers
+    may see the last values partially counted.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds):
+        """
+        Args:
+            bounds: ascending upper bounds, +Inf bucket is implied
+        """
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Returns:
+            list: (upper bound, values less or equal to it), the last
+                bound is +Inf
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        Estimate of the quantile, linear within the bucket as
+        histogram_quantile of Prometheus does.
+
+        Returns:
+            float: the value or None if there are no values
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if total == 0:
+            return None
+
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if i == len(self.bounds):
+                    # +Inf bucket, the highest finite bound is the best guess
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * \
+                    (rank - seen) / count
+            seen += count
+
+        return self.bounds[-1]
+
+    def __repr__(self):
+        return "Histogram(count={0}, sum={1})".format(self.count, self.sum)
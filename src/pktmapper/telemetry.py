@@ -0,0 +1,165 @@
+"""
+Timings of the mapper pipeline
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from collections import OrderedDict
+from stats import exponential_buckets
+from stats import Histogram
+from threading import Thread
+import json
+import os
+import tempfile
+import time
+
+
+PREFIX = "pktmapper_"
+
+# Name of the histogram and its help, all of them are in seconds
+HISTOGRAMS = (
+    ("decode", "Decoding of the packet headers."),
+    ("hash", "Making the flow key of the packet."),
+    ("update", "Update of the flow table by the packet, with the lock wait."),
+    ("queued", "Wait of a ready flow in the queue of the classifier."),
+    ("predict", "Predict call of a batch of ready flows."),
+    ("latency", "From the first packet of a flow to its verdict."),
+)
+
+# 1 us to 16 s
+BUCKETS = exponential_buckets(1e-6, 2, 25)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Telemetry(object):
+    """
+    Histograms of the pipeline stages and the counters of the mapper.
+
+    Every histogram is updated by one thread: the capture one for
+    decode, hash and update, the collector for the others. Snapshots
+    and scrapes read them as they are, without locking.
+    """
+
+    def __init__(self, values):
+        """
+        Args:
+            values: function which returns a list of
+                (name, "counter" or "gauge", help, value)
+        """
+        self.values = values
+        self.histograms = OrderedDict(
+            (name, Histogram(BUCKETS)) for name, _ in HISTOGRAMS)
+        self.server = None
+
+    def __getitem__(self, name):
+        return self.histograms[name]
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: the values, count, sum, quantiles and cumulative
+                buckets of every histogram
+        """
+        result = OrderedDict([("time", time.time())])
+        for name, _, _, value in self.values():
+            result[name] = value
+
+        histograms = result["seconds"] = OrderedDict()
+        for name, histogram in self.histograms.iteritems():
+            buckets = histogram.cumulative()
+            summary = OrderedDict([
+                ("count", buckets[-1][1]),
+                ("sum", histogram.sum)
+            ] + [
+                ("p{0:g}".format(q * 100), histogram.quantile(q))
+                for q in QUANTILES
+            ])
+            # +Inf bucket is the count
+            summary["buckets"] = buckets[:-1]
+            histograms[name] = summary
+
+        return result
+
+    def save(self, filename):
+        """
+        Replace the file with the snapshot, readers never see a part
+        of it.
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.snapshot(), f, indent=1)
+            os.rename(temporary, filename)
+        except Exception:
+            os.remove(temporary)
+            raise
+
+    def prometheus(self):
+        """
+        Returns:
+            str: all metrics in the Prometheus text format
+        """
+        lines = []
+        for name, kind, text, value in self.values():
+            name = PREFIX + name
+            lines.append("# HELP {0} {1}".format(name, text))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            lines.append("{0} {1}".format(name, value))
+
+        for name, text in HISTOGRAMS:
+            histogram = self.histograms[name]
+            name = PREFIX + name + "_seconds"
+            lines.append("# HELP {0} {1}".format(name, text))
+            lines.append("# TYPE {0} histogram".format(name))
+            buckets = histogram.cumulative()
+            for bound, count in buckets[:-1]:
+                lines.append('{0}_bucket{{le="{1!r}"}} {2}'.format(
+                    name, bound, count))
+            lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(
+                name, buckets[-1][1]))
+            lines.append("{0}_sum {1!r}".format(name, histogram.sum))
+            lines.append("{0}_count {1}".format(name, buckets[-1][1]))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve /metrics on the port in a daemon thread.
+        """
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = telemetry.prometheus()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,454 @@
+"""
+Vectorized feature extraction for a whole capture
+---
+
+Package: PACKET-MAPPER
+Author: Sapunov Nikita <kiton1994@gmail.com>
+"""
+
+
+from flow import FEATURES
+from flowtable import COUNTERS
+from flowtable import STATS_DTYPE
+from preprocessing import ETH_TYPE_OFFSET
+from preprocessing import ETH_TYPE_VLAN
+from preprocessing import PLAIN_HEADERS
+from preprocessing import PLAIN_IPV4
+from preprocessing import PLAIN_IPV4_AT
+from preprocessing import UDP_HDR_LEN
+from preprocessing import VLAN_TAG_LEN
+from preprocessing import flow_key
+from preprocessing import packet_data
+from preprocessing import raw_keys
+
+import array
+import dpkt
+import numpy as np
+import struct
+
+
+# How many VLAN tags decode_index() unwraps, deeper frames go through
+# packet_data()
+MAX_VLAN_TAGS = 2
+
+IP_HDR_LEN = 20
+# Bytes of the transport header packet_data() needs
+TCP_HDR_NEED = 13
+UDP_HDR_NEED = 4
+
+# Records decoded between progress reports. decode_index() parses
+# headers of that many records at once.
+CHUNK = 1 << 16
+
+# ip_a, port_a, ip_b, port_b, proto
+_FLOW_KEY = struct.Struct("!IHIHB")
+_IP = struct.Struct("!I")
+
+
+# Features which are integers in the Flow record
+INTEGER_FEATURES = tuple(
+    FEATURES.index(name) for name in (
+        "count_dir",
+        "count_back",
+        "overall_dir",
+        "overall_back",
+        "max_payload_dir",
+        "max_payload_back",
+        "min_payload_dir",
+        "min_payload_back",
+        "var_payload_dir",
+        "var_payload_back"
+    )
+)
+
+
+def decode(pcap, labels, progress=None):
+    """
+    Decode packets of the labeled flows into columns.
+
+    Args:
+        pcap: reader of the capture, iterable of (timestamp, data) with
+            position and size
+        labels: dict with flow key and name of the application
+        progress: function(bytes, packets) called for every CHUNK
+            records read and at the end
+    Returns:
+        tuple: (keys, timestamps, flows, directions, payloads)
+            keys - list of flow keys, flows column holds indexes in it
+            directions - 1 for dir packets, 0 for back
+    """
+    index = {}
+    keys = []
+    origins = []
+    labeled = raw_keys(labels)
+
+    timestamps = array.array("d")
+    flows = array.array("l")
+    directions = array.array("b")
+    payloads = array.array("l")
+
+    done = 0
+    count = 0
+    for timestamp, data in pcap:
+        count += 1
+        if count == CHUNK and progress is not None:
+            progress(pcap.position - done, count)
+            done = pcap.position
+            count = 0
+
+        if data[PLAIN_IPV4_AT] == PLAIN_IPV4 and \
+                data[PLAIN_HEADERS] not in labeled:
+            continue
+
+        pkt = packet_data(data)
+        if pkt is None:
+            continue
+
+        proto, ip_a, ip_b, port_a, port_b, payload = pkt
+        fid = flow_key(ip_a, ip_b, port_a, port_b, proto)
+
+        if fid not in labels:
+            continue
+
+        idx = index.get(fid)
+        if idx is None:
+            idx = index[fid] = len(keys)
+            keys.append(fid)
+            origins.append(ip_a)
+
+        timestamps.append(timestamp)
+        flows.append(idx)
+        directions.append(ip_a == origins[idx])
+        payloads.append(payload)
+
+    if progress is not None:
+        progress(pcap.size - done, count)
+
+    return (
+        keys,
+        np.frombuffer(timestamps, dtype=np.float64),
+        np.frombuffer(flows, dtype=np.dtype("l")),
+        np.frombuffer(directions, dtype=np.int8),
+        np.frombuffer(payloads, dtype=np.dtype("l"))
+    )
+
+
+def _be16(buf, offsets):
+    return (buf[offsets].astype(np.int64) << 8) | buf[offsets + 1]
+
+
+def _be32(buf, offsets):
+    return (_be16(buf, offsets) << 16) | _be16(buf, offsets + 2)
+
+
+def _take(mask, *columns):
+    return [column[mask] for column in columns]
+
+
+def _parse_index(buf, offsets, lengths):
+    """
+    Parse Ethernet/IPv4/TCP/UDP headers of all records at once.
+
+    Returns:
+        tuple: (packets, proto, ip_a, ip_b, port_a, port_b, payload, odd)
+            columns of the parsed TCP/UDP packets (ip addresses as
+            integers) with indexes of their records, odd - indexes of
+            the records which have to be parsed by packet_data()
+    """
+    odd = [np.flatnonzero(lengths < ETH_TYPE_OFFSET + 2)]
+
+    packets = np.flatnonzero(lengths >= ETH_TYPE_OFFSET + 2)
+    pos = offsets[packets] + ETH_TYPE_OFFSET
+    end = offsets[packets] + lengths[packets]
+    eth_type = _be16(buf, pos)
+
+    for i in range(MAX_VLAN_TAGS):
+        vlan = np.in1d(eth_type, ETH_TYPE_VLAN)
+        if not vlan.any():
+            break
+        pos = pos + vlan * VLAN_TAG_LEN
+
+        short = vlan & (pos + 2 > end)
+        odd.append(packets[short])
+        packets, pos, end, eth_type, vlan = _take(
+            ~short, packets, pos, end, eth_type, vlan)
+        eth_type[vlan] = _be16(buf, pos[vlan])
+
+    odd.append(packets[np.in1d(eth_type, ETH_TYPE_VLAN)])
+    packets, pos, end = _take(
+        eth_type == dpkt.ethernet.ETH_TYPE_IP, packets, pos, end)
+    pos += 2
+    #
+    # ip
+    #
+    short = pos + IP_HDR_LEN > end
+    odd.append(packets[short])
+    packets, pos, end = _take(~short, packets, pos, end)
+
+    v_hl = buf[pos].astype(np.int64)
+    version = (v_hl >> 4) == 4
+    odd.append(packets[~version])
+
+    proto = buf[pos + 9].astype(np.int64)
+    frag = _be16(buf, pos + 6) & dpkt.ip.IP_OFFMASK
+    keep = version & ((proto == dpkt.ip.IP_PROTO_TCP) |
+                      (proto == dpkt.ip.IP_PROTO_UDP)) & (frag == 0)
+    packets, pos, end, v_hl, proto = _take(
+        keep, packets, pos, end, v_hl, proto)
+
+    length = _be16(buf, pos + 2)
+    ip_a = _be32(buf, pos + 16)
+    ip_b = _be32(buf, pos + 12)
+    ip_end = np.where(length > 0, np.minimum(pos + length, end), end)
+    pos = pos + ((v_hl & 0xf) << 2)
+    #
+    # transport
+    #
+    tcp = proto == dpkt.ip.IP_PROTO_TCP
+    short = pos + np.where(tcp, TCP_HDR_NEED, UDP_HDR_NEED) > end
+    odd.append(packets[short])
+    packets, pos, ip_end, proto, ip_a, ip_b, tcp = _take(
+        ~short, packets, pos, ip_end, proto, ip_a, ip_b, tcp)
+
+    port_a = _be16(buf, pos + 2)
+    port_b = _be16(buf, pos)
+    off_x2 = buf[np.where(tcp, pos + 12, pos)].astype(np.int64)
+    start = pos + np.where(tcp, (off_x2 >> 4) << 2, UDP_HDR_LEN)
+
+    short = start > ip_end
+    odd.append(packets[short])
+    packets, proto, ip_a, ip_b, port_a, port_b, start, ip_end = _take(
+        ~short, packets, proto, ip_a, ip_b, port_a, port_b, start, ip_end)
+
+    return (
+        packets,
+        proto,
+        ip_a,
+        ip_b,
+        port_a,
+        port_b,
+        ip_end - start,
+        np.sort(np.concatenate(odd))
+    )
+
+
+def decode_index(reader, labels, progress=None):
+    """
+    Decode packets of the labeled flows into columns using the record
+    index of the pcapfile.Reader. Headers are parsed with array
+    operations in chunks of records, flows are found by sorting, only
+    unusual frames and distinct flows are handled one by one.
+
+    Args:
+        reader: pcapfile.Reader instance
+        labels: dict with flow key and name of the application
+        progress: function(bytes, packets) called for every parsed
+            chunk and at the end
+    Returns:
+        tuple: the same as decode() returns
+    """
+    timestamps, offsets, lengths = reader.index()
+    timestamps = np.frombuffer(timestamps, dtype=np.float64)
+    offsets = np.frombuffer(offsets, dtype=np.dtype("l"))
+    lengths = np.frombuffer(lengths, dtype=np.dtype("l"))
+    buf = np.frombuffer(reader.data, dtype=np.uint8)
+
+    chunks = []
+    done = 0
+    for start in xrange(0, max(len(offsets), 1), CHUNK):
+        stop = min(start + CHUNK, len(offsets))
+        chunk = list(_parse_index(buf, offsets[start:stop],
+                                  lengths[start:stop]))
+        # indexes of records in the chunk
+        chunk[0] += start
+        chunk[-1] += start
+        chunks.append(chunk)
+
+        if progress is not None and stop > start:
+            end = int(offsets[stop - 1] + lengths[stop - 1])
+            progress(end - done, stop - start)
+            done = end
+
+    if progress is not None:
+        progress(reader.size - done, 0)
+
+    columns = [np.concatenate(column) for column in zip(*chunks)]
+    odd = columns[-1]
+    columns = columns[:-1]
+
+    if len(odd):
+        parsed = []
+        for i in odd.tolist():
+            pkt = packet_data(buffer(reader.data, offsets[i], lengths[i]))
+            if pkt is not None:
+                proto, ip_a, ip_b, port_a, port_b, payload = pkt
+                parsed.append((
+                    i, proto, _IP.unpack(ip_a)[0], _IP.unpack(ip_b)[0],
+                    port_a, port_b, payload
+                ))
+
+        if parsed:
+            parsed = zip(*parsed)
+            columns = [
+                np.concatenate((column, np.array(extra, column.dtype)))
+                for column, extra in zip(columns, parsed)
+            ]
+            order = np.argsort(columns[0], kind="mergesort")
+            columns = [column[order] for column in columns]
+
+    packets, proto, ip_a, ip_b, port_a, port_b, payloads = columns
+    #
+    # flows
+    #
+    endpoint_a = (ip_a << 16) | port_a
+    endpoint_b = (ip_b << 16) | port_b
+    low = np.minimum(endpoint_a, endpoint_b)
+    high = (np.maximum(endpoint_a, endpoint_b) << 8) | proto
+
+    order = np.lexsort((high, low))
+    change = np.r_[
+        True,
+        (low[order][1:] != low[order][:-1]) |
+        (high[order][1:] != high[order][:-1])
+    ]
+    groups = np.empty(len(order), dtype=np.int64)
+    groups[order] = np.cumsum(change) - 1
+
+    # Flows are numbered in order of their first packets
+    firsts = np.sort(order[change])
+    number = np.empty(len(firsts), dtype=np.int64)
+    number[groups[firsts]] = np.arange(len(firsts))
+    flows = number[groups]
+
+    keys = []
+    labeled = np.zeros(len(firsts), dtype=np.bool_)
+    for i, (lo, hi) in enumerate(zip(low[firsts].tolist(),
+                                     high[firsts].tolist())):
+        fid = _FLOW_KEY.pack(
+            lo >> 16, lo & 0xffff, hi >> 24, (hi >> 8) & 0xffff, hi & 0xff)
+        if fid in labels:
+            labeled[i] = True
+            keys.append(fid)
+
+    keep = labeled[flows]
+    renumber = np.cumsum(labeled) - 1
+    flows = renumber[flows[keep]]
+    origins = ip_a[firsts[labeled]]
+
+    return (
+        keys,
+        timestamps[packets[keep]],
+        flows,
+        (ip_a[keep] == origins[flows]).astype(np.int8),
+        payloads[keep]
+    )
+
+
+def _moments(values, groups, size):
+    """
+    Grouped min, max, mean and population std.
+
+    Args:
+        values: samples sorted by group
+        groups: group of every sample, non-decreasing
+        size: number of groups
+    Returns:
+        tuple: (min, max, mean, std) arrays, zeros for empty groups
+    """
+    count = np.bincount(groups, minlength=size).astype(np.float64)
+    total = np.bincount(groups, weights=values, minlength=size)
+
+    mean = np.zeros(size)
+    present = count > 0
+    mean[present] = total[present] / count[present]
+
+    deviation = np.bincount(
+        groups, weights=(values - mean[groups]) ** 2, minlength=size)
+    std = np.zeros(size)
+    std[present] = np.sqrt(deviation[present] / count[present])
+
+    minimum = np.zeros(size)
+    maximum = np.zeros(size)
+    if len(values):
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        minimum[groups[starts]] = np.minimum.reduceat(values, starts)
+        maximum[groups[starts]] = np.maximum.reduceat(values, starts)
+
+    return minimum, maximum, mean, std
+
+
+def features(timestamps, flows, directions, payloads, size, threshold,
+             volume=True):
+    """
+    Calculate features of all flows at once. The result is the same
+    as processing packets one by one with Flow.update() for the first
+    threshold packets of the flow and Flow.count() for the rest.
+
+    Args:
+        timestamps, flows, directions, payloads: columns from decode()
+        size: number of flows
+        threshold: how many packets of the flow are calculated
+        volume: count the packets after the threshold
+    Returns:
+        numpy.ndarray: (size, 24) matrix in the order of FEATURES
+    """
+    matrix = np.zeros((size, len(FEATURES)))
+    if size == 0:
+        return matrix
+
+    back = directions == 0
+    payloads = payloads.astype(np.float64)
+
+    # Packets in capture order within every flow
+    order = np.argsort(flows, kind="mergesort")
+    ordered = flows[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    lengths = np.diff(np.r_[starts, len(ordered)])
+    rank = np.arange(len(ordered)) - np.repeat(starts, lengths)
+
+    # Only the first threshold packets get into the statistics.
+    # Group is 2 * flow for dir and 2 * flow + 1 for back.
+    order = order[rank < threshold]
+
+    counted = slice(None) if volume else order
+    for column, weights in (
+            (0, ~back), (1, back),
+            (2, payloads * ~back), (3, payloads * back)):
+        matrix[:, column] = np.bincount(
+            flows[counted], weights=weights[counted], minlength=size)
+    groups = flows[order] * 2 + back[order]
+    regroup = np.argsort(groups, kind="mergesort")
+    order = order[regroup]
+    groups = groups[regroup]
+
+    payload_stats = _moments(payloads[order], groups, size * 2)
+
+    gaps = np.diff(timestamps[order])
+    same = groups[1:] == groups[:-1]
+    itime_stats = _moments(gaps[same], groups[1:][same], size * 2)
+
+    for offset, (minimum, maximum, mean, std) in (
+            (4, itime_stats), (14, payload_stats)):
+        for direction in (0, 1):
+            column = offset + direction
+            matrix[:, column] = maximum[direction::2]
+            matrix[:, column + 2] = minimum[direction::2]
+            matrix[:, column + 4] = mean[direction::2]
+            matrix[:, column + 6] = std[direction::2]
+            matrix[:, column + 8] = maximum[direction::2] - \
+                minimum[direction::2]
+
+    return matrix
+
+
+def rows(matrix):
+    """
+    Feature rows as python values the same types as Flow.features() has
+    and the statistics with the precision FlowTable.export() gives.
+    """
+    counts = matrix[:, :COUNTERS].tolist()
+    stats = matrix[:, COUNTERS:].astype(STATS_DTYPE).tolist()
+    for row in (i + j for i, j in zip(counts, stats)):
+        for i in INTEGER_FEATURES:
+            row[i] = int(row[i])
+        yield row
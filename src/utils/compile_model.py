@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Script for compiling trained tree ensembles for the mapper.
+"""
+
+from pktmapper import ensemble
+
+import argparse
+import cPickle as pickle
+import logging
+import numpy as np
+import sys
+
+
+log_format = u"%(asctime)s %(message)s"
+logging.basicConfig(level=logging.INFO, datefmt="%d.%m.%y_%H:%M:%S",
+                    format=log_format)
+
+# Samples of the self check
+CHECK_SAMPLES = 100000
+
+
+def _width(model):
+    if hasattr(model, "n_features_"):
+        return model.n_features_
+    return model.estimators_[0].n_features_
+
+
+def check(model, compiled, samples):
+    """
+    Compare predictions on the samples made of the split thresholds
+    and their float32 neighbours, where the walks are easy to get wrong.
+
+    Returns:
+        int: samples predicted differently
+    """
+    rng = np.random.RandomState(0)
+    width = _width(model)
+
+    X = np.zeros((samples, width), dtype=np.float32)
+    inner = ~compiled.leaf
+    for column in xrange(width):
+        thresholds = compiled.thresholds[inner & (compiled.features == column)]
+        if not len(thresholds):
+            continue
+        values = thresholds.astype(np.float32)
+        values = np.concatenate((
+            values,
+            np.nextafter(values, np.float32(-np.inf)),
+            np.nextafter(values, np.float32(np.inf))
+        ))
+        X[:, column] = rng.choice(values, samples)
+
+    return int((model.predict(X) != compiled.predict(X)).sum())
+
+
+def compile_file(model_file, output, samples=CHECK_SAMPLES):
+    with open(model_file, "rb") as fid:
+        model = pickle.load(fid)
+
+    compiled = ensemble.compile_model(model)
+    logging.info("Model [{0}] compiled: {1} trees, {2} nodes".format(
+        model_file, len(compiled), len(compiled.features)))
+
+    if samples:
+        mismatches = check(model, compiled, samples)
+        if mismatches:
+            logging.error("{0} of {1} samples are predicted differently. "
+                          "Not saved.".format(mismatches, samples))
+            return False
+        logging.info("Predictions of {0} samples are the same".format(
+            samples))
+
+    compiled.save(output)
+    logging.info("Saved in [{0}]".format(output))
+
+    return True
+
+
+parser = argparse.ArgumentParser(
+    description="Compile a tree ensemble for the mapper.")
+parser.add_argument(
+    "model",
+    help="Pickled DecisionTreeClassifier, RandomForestClassifier, "
+         "ExtraTreesClassifier or AdaBoostClassifier."
+)
+parser.add_argument(
+    "output",
+    help="Compiled model file (npz)."
+)
+parser.add_argument(
+    "--samples",
+    type=int,
+    default=CHECK_SAMPLES,
+    help="How many samples are predicted by both models before saving. "
+         "It's [{0}] by default, 0 skips the check.".format(CHECK_SAMPLES)
+)
+
+
+def main():
+    args = parser.parse_args()
+    if not compile_file(args.model, args.output, args.samples):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
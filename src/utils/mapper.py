@@ -1,18 +1,47 @@
 #!/usr/bin/env python
 
+from pktmapper import ensemble
 from pktmapper import preprocessing
+from pktmapper.common import ip2str
+from pktmapper.expiry import Expiry
+from pktmapper.flowtable import FlowTable
 from pktmapper.inet import interface_list
+from pktmapper.pcapfile import open_capture
+from pktmapper.telemetry import Telemetry
+from collections import deque
+from Queue import Empty
+from Queue import Queue
+from threading import Lock
 from threading import Thread
 from time import sleep
+from time import time
 import cPickle as pickle
 
 import argparse
+import json
 import logging
+import numpy as np
 import os
 import pcap
 import sys
 
 
+RESULTS_HEADER = \
+    "type,proto,count_dir,count_back,overall_dir,overall_back,meta\n"
+
+# Seconds between status lines and exports of timed out flows
+STATUS_INTERVAL = 0.5
+# Ready flows classified by one predict call at most
+BATCH_SIZE = 256
+# Seconds the first ready flow waits for others to fill the batch
+BATCH_DELAY = 0.005
+# Capture buffer of the paced replay, the default of libpcap on Linux
+REPLAY_BUFFER = 2 * 1024 * 1024
+# Percentiles of the threshold to verdict latency in the replay report
+LATENCY_PERCENTILES = (50, 90, 99)
+# Seconds between snapshots of the stats file
+STATS_INTERVAL = 5.0
+
 log_format = u"%(asctime)s %(message)s"
 logging.basicConfig(level=logging.INFO, datefmt="%d.%m.%y_%H:%M:%S",
                     format=log_format)
@@ -31,7 +60,9 @@ def _interface_list():
 
 
 class Mapper:
-    def __init__(self, threshold, model, features, results):
+    def __init__(self, threshold, model, features, results, idle=None,
+                 active=None, batch_size=None, batch_delay=None,
+                 compiled=True, stats_file=None, stats_port=None):
         self.__stop = False
         if features is not None:
             if len(features) == 1 and "," in features[0]:
@@ -42,149 +73,572 @@ class Mapper:
         # Last good features set:
         # [17, 23, 7, 5, 15, 3, 1, 4, 2, 21, 9, 24]
         self.results = results
-        self.flows = {}
+        # Classified flows have an application, the others are waiting
+        # for the threshold
+        self.flows = FlowTable()
+        # Flows which have just reached the threshold: (key, first
+        # timestamp, features, time of the threshold, time of the first
+        # packet or None)
+        self.ready = Queue()
+        self.lock = Lock()
         self.meta = {}
         self.pcounter = 0
-        self.temp_flows = {}
+        self.fcounter = 0
+        self.classified = 0
+        # Packets dropped by the replay
+        self.dropped = 0
+        # Seconds from the threshold to the verdict of every flow,
+        # only collected by the replay
+        self.latencies = None
+        # Timed out flows waiting to be saved in results
+        self.expiry = Expiry(idle, active)
+        self.expired = []
         if threshold is not None:
             self.threshold = threshold
         else:
             self.threshold = 8
+        if batch_size is not None:
+            self.batch_size = batch_size
+        else:
+            self.batch_size = BATCH_SIZE
+        if batch_delay is not None:
+            self.batch_delay = batch_delay
+        else:
+            self.batch_delay = BATCH_DELAY
+        # Tree ensembles are evaluated by pktmapper.ensemble
+        self.compiled = compiled
+        # Stage timings are only measured when they are exported
+        self.stats_file = stats_file
+        self.stats_port = stats_port
+        if stats_file is not None or stats_port is not None:
+            self.telemetry = Telemetry(self._values)
+            # Wall time of the first packet of the flows under the threshold
+            self.arrived = {}
+        else:
+            self.telemetry = None
+            self.arrived = None
         if model is not None:
             self.model = model
         else:
             raise ModelNotSpecified()
 
-    def _recalc_flow(self, fid, ip_a, payload):
-        app, cd, cb, pd, pb, ip = self.flows[fid]
-        if ip == ip_a:
-            # dir
-            self.flows[fid] = (app, cd + 1, cb, pd + payload, pb, ip_a)
-        else:
-            # back
-            self.flows[fid] = (app, cd, cb + 1, pd, pb + payload, ip_a)
-
     def _load_classifier(self):
         logging.info("Loading model [{0}] ...".format(self.model))
         
-        with open(self.model, "rb") as fid:
-            model = pickle.load(fid)
+        if ensemble.is_compiled(self.model):
+            model = ensemble.load(self.model)
+        else:
+            with open(self.model, "rb") as fid:
+                model = pickle.load(fid)
+            if self.compiled:
+                model = self._compile(model)
 
         logging.info("Model [{0}] loaded. Availible classes: {1}".format(
             self.model, list(model.classes_)))
 
         return model
 
-    def _fit_features(self, fid):
-        new_flow = ()
+    def _compile(self, model):
+        """
+        Ensembles of trees are compiled, a single tree is as fast in
+        sklearn as it is.
+        """
+        try:
+            compiled = ensemble.compile_model(model)
+        except ValueError:
+            return model
+
+        if compiled.kind == ensemble.TREE:
+            return model
+
+        logging.info("Model [{0}] compiled: {1} trees".format(
+            self.model, len(compiled)))
+        return compiled
+
+    def _fit_features(self, features):
         if len(self.features) > 0:
-            for feat in self.features:
-                new_flow += (self.temp_flows[fid][feat],)
-        else:
-            new_flow = self.temp_flows[fid][1:25]
+            # Indexes are counted from 1 like columns after application
+            return features[:, [feat - 1 for feat in self.features]]
 
-        return new_flow
+        return features
 
-    def _collector(self):
+    def _collector(self, model):
         logging.info(
             "Collector started. Threshold: {0}. Features: {1}".format(
                 self.threshold, self.features
             )
         )
-
-        try:
-            model = self._load_classifier()
-        except Exception:
-            logging.error("Bad model")
-            self.__stop = True
         logging.info("Waiting for the first match")
 
+        while True:
+            batch = self._batch()
+            if batch is None:
+                break
+            self._classify(model, batch)
+
+    def _batch(self):
+        """
+        Ready flows for one predict call. Waits for the first one, then
+        up to batch_delay for the others while there are less than
+        batch_size of them.
+
+        Returns:
+            list: (key, first timestamp, features, queued, arrived) or
+                None when stopped
+        """
+        item = self.ready.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time()
+            try:
+                if timeout > 0:
+                    item = self.ready.get(timeout=timeout)
+                else:
+                    item = self.ready.get_nowait()
+            except Empty:
+                break
+
+            if item is None:
+                # Stop after this batch
+                self.ready.put(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _classify(self, model, batch):
+        """
+        Classify the flows by the features they had at the threshold.
+        """
+        keys, firsts, features, queued, arrived = zip(*batch)
+        matrix = self._fit_features(np.array(features, dtype=np.float32))
+
+        started = time()
+        apps = model.predict(matrix)
+        now = time()
+
+        if self.latencies is not None:
+            self.latencies.extend(now - i for i in queued)
+
+        if self.telemetry is not None:
+            self.telemetry["predict"].observe(now - started)
+            for i in queued:
+                self.telemetry["queued"].observe(started - i)
+            for i in arrived:
+                self.telemetry["latency"].observe(now - i)
+
+        classified = []
+        with self.lock:
+            for i, first, app in zip(keys, firsts, apps):
+                row = self.flows.row(i)
+                if row is None or self.flows.first[row] != first:
+                    # Expired while waiting in the queue
+                    continue
+                self.flows.set_app(row, app)
+                classified.append((self.flows.counters(i), self.meta[i]))
+        self.classified += len(classified)
+
+        for counters, meta in classified:
+            print("\rFlow classified: {0} {1}".format(
+                counters,
+                (meta,)
+            ))
+
+    def _status(self):
+        """
+        Print the status line and save timed out flows periodically.
+        """
+        saved = time()
         while not self.__stop:
-            for i, metrics in self.temp_flows.items():
-                if (metrics[1] + metrics[2]) >= self.threshold:
-                    flow_tuple = self._fit_features(i)
-
-                    app = list(model.predict(flow_tuple))[0]
-
-                    self.flows[i] = (app,) + metrics[1:5] + (metrics[-1],)
-                    del self.temp_flows[i]
-                    print("\rFlow classified: {0} {1}".format(
-                        self.flows[i][:-1],
-                        (self.meta[i],)
-                    ))
-
+            sleep(STATUS_INTERVAL)
             sys.stdout.write(
                 "\rReceived packets: {0}. Classified flows: {1}. Detected flows: {2}".format(
                     self.pcounter,
-                    len(self.flows),
-                    len(self.flows) + len(self.temp_flows)
+                    self.classified,
+                    len(self.flows)
                 )
             )
             sys.stdout.flush()
-            sleep(0.5)
+            self._export_expired()
+            if self.stats_file is not None and \
+                    time() - saved >= STATS_INTERVAL:
+                self.telemetry.save(self.stats_file)
+                saved = time()
+
+    def _values(self):
+        """
+        Counters and gauges of the stats.
+
+        Returns:
+            list: (name, kind, help, value)
+        """
+        return [
+            ("packets_total", "counter", "Processed packets.", self.pcounter),
+            ("dropped_total", "counter", "Packets dropped by the replay.",
+             self.dropped),
+            ("flows_total", "counter", "Detected flows.", self.fcounter),
+            ("classified_total", "counter", "Classified flows.",
+             self.classified),
+            ("flows", "gauge", "Flows in the flow table.", len(self.flows)),
+            ("ready_flows", "gauge", "Flows waiting for the classifier.",
+             self.ready.qsize()),
+        ]
+
+    def stop(self):
+        """
+        Stop the collector and the status threads.
+        """
+        self.__stop = True
+        self.ready.put(None)
 
     def _process_packet(self, payload, data, timestamp):
         if self.__stop:
             raise Exception
 
+        if self.telemetry is not None:
+            return self._timed_packet(payload, data, timestamp)
+
         pkt = preprocessing.packet_data(data)
         if pkt is not None:
-            transport, ip_a, ip_b, port_a, port_b = pkt[:-1]
+            proto, ip_a, ip_b, port_a, port_b = pkt[:-1]
         else:
             return
 
-        self.pcounter += 1
-
-        fid = preprocessing.flow_hash(
-            ip_a, ip_b, port_a, port_b, transport
+        fid = preprocessing.flow_key(
+            ip_a, ip_b, port_a, port_b, proto
         )
 
-        if fid not in self.flows:
-            preprocessing.flow_processing(
-                fid, payload, timestamp, ip_a, self.temp_flows, None
-            )
-            self.meta[fid] = "{0}:{1}<->{2}:{3}_{4}".format(
-                ip_a, port_a, ip_b, port_b, transport
-            )
+        self._update(fid, proto, ip_a, ip_b, port_a, port_b, payload,
+                     timestamp)
+
+    def _timed_packet(self, payload, data, timestamp):
+        """
+        _process_packet which measures its stages.
+        """
+        started = time()
+        pkt = preprocessing.packet_data(data)
+        decoded = time()
+        self.telemetry["decode"].observe(decoded - started)
+        if pkt is not None:
+            proto, ip_a, ip_b, port_a, port_b = pkt[:-1]
         else:
-            # This recalc. Only +1 to the counters
-            self._recalc_flow(fid, ip_a, payload)
+            return
 
-    def _export_json(self, filename):
-        header = "type,proto,count_dir,count_back,overall_dir,overall_back,meta\n"
-        with open(filename, "w"):
-            pass
-        with open(filename, "a") as fid:
-            fid.write(header)
+        fid = preprocessing.flow_key(
+            ip_a, ip_b, port_a, port_b, proto
+        )
+        hashed = time()
+        self.telemetry["hash"].observe(hashed - decoded)
+
+        self._update(fid, proto, ip_a, ip_b, port_a, port_b, payload,
+                     timestamp, started)
+        self.telemetry["update"].observe(time() - hashed)
+
+    def _update(self, fid, proto, ip_a, ip_b, port_a, port_b, payload,
+                timestamp, arrived=None):
+        """
+        Add the packet to its flow, the flow goes to the classifier
+        when it reaches the threshold.
+
+        Args:
+            arrived: wall time of the packet, kept for the first packet
+                of the flow when stages are measured
+        """
+        self.pcounter += 1
 
-            for i, data in self.flows.items():
-                t = "classified,{0},{1}\n".format(
-                    ",".join(map(str, data[:5])), self.meta[i])
+        with self.lock:
+            if self.expiry.enabled:
+                self._expire(timestamp)
+
+            flow = self.flows.flow(fid)
+            if flow is not None:
+                flow.update(payload, timestamp, ip_a)
+            else:
+                row = self.flows.row(fid)
+                if row is None:
+                    flow = self.flows.add(fid, None, payload, timestamp, ip_a)
+                    self.meta[fid] = "{0}:{1}<->{2}:{3}_{4}".format(
+                        ip2str(ip_a), port_a, ip2str(ip_b), port_b,
+                        preprocessing.PROTOCOLS[proto]
+                    )
+                    if self.expiry.enabled:
+                        self.expiry.add(fid, timestamp)
+                    if arrived is not None:
+                        self.arrived[fid] = arrived
+                    self.fcounter += 1
+                else:
+                    # This recalc. Only +1 to the counters
+                    self.flows.count(row, payload, ip_a)
+
+            if flow is not None and flow.packets >= self.threshold:
+                # Features are final, the flow goes to the classifier
+                self.flows.freeze(fid)
+                self.ready.put((
+                    fid,
+                    flow.first_dir,
+                    flow.features(),
+                    time(),
+                    self.arrived.pop(fid) if self.arrived is not None
+                    else None
+                ))
+
+            if self.expiry.enabled:
+                self.expiry.touch(fid, timestamp)
+
+    def _expire(self, timestamp):
+        """
+        Move flows which are timed out from the flow table to the results.
+        Must be called under the lock.
+        """
+        for fid in self.expiry.expire(timestamp):
+            counters = self.flows.counters(fid)
+            if counters[0] is not None:
+                kind = "classified"
+            else:
+                kind = "unclassified"
+
+            self.expired.append((kind, counters, self.meta.pop(fid)))
+            self.flows.remove(fid)
+            if self.arrived is not None:
+                self.arrived.pop(fid, None)
+
+    def _export_expired(self):
+        """
+        Save timed out flows in results.
+        """
+        with self.lock:
+            expired = self.expired
+            self.expired = []
+
+        if self.results is not None and expired:
+            self._export_rows(self.results, expired)
+
+    def _export_rows(self, filename, rows):
+        with open(filename, "a") as fid:
+            for kind, counters, meta in rows:
+                t = "{0},{1},{2}\n".format(
+                    kind, ",".join(map(str, counters)), meta)
                 fid.write(t)
 
-            for i, data in self.temp_flows.items():
-                t = "unclassified,{0},{1}\n".format(
-                    ",".join(map(str, data[:5])), self.meta[i])
-                fid.write(t)
+    def _export_json(self, filename):
+        rows = self.expired
+        self.expired = []
+
+        flows = [(self.flows.counters(key), self.meta[key])
+                 for key in self.flows.keys + self.flows.live.keys()]
+
+        for kind, classified in (("classified", True),
+                                 ("unclassified", False)):
+            for counters, meta in flows:
+                if (counters[0] is not None) == classified:
+                    rows.append((kind, counters, meta))
+
+        self._export_rows(filename, rows)
+
+    def _threads(self):
+        """
+        Load the model and start the collector and the status threads.
+
+        Returns:
+            list: started threads or None if the model can't be loaded
+        """
+        try:
+            model = self._load_classifier()
+        except Exception:
+            logging.error("Bad model")
+            return None
+
+        if self.stats_port is not None:
+            self.telemetry.serve(self.stats_port)
+            logging.info("Stats are served on [http://127.0.0.1:{0}/metrics]"
+                         .format(self.stats_port))
+
+        threads = [
+            Thread(target=self._collector, args=(model,)),
+            Thread(target=self._status)
+        ]
+        for thread in threads:
+            thread.start()
+
+        return threads
+
+    def _close_stats(self):
+        """
+        Save the last snapshot and stop serving the stats.
+        """
+        if self.telemetry is None:
+            return
+
+        if self.stats_file is not None:
+            self.telemetry.save(self.stats_file)
+            logging.info("\rStats saved in [{0}]".format(self.stats_file))
+        self.telemetry.shutdown()
+
+    def _results(self):
+        if self.results is not None:
+            self._export_json(self.results)
+            logging.info("\rResults saved in [{0}]".format(self.results))
 
     def start(self, interface):
+        if self.results is not None:
+            with open(self.results, "w") as fid:
+                fid.write(RESULTS_HEADER)
+
+        threads = self._threads()
+        if threads is None:
+            return
+
         p = pcap.pcapObject()
 
         p.open_live(interface, 500, True, 0)
 
-        collector_thread = Thread(target=self._collector)
-        collector_thread.start()
-
         try:
             p.loop(0, self._process_packet)
         except KeyboardInterrupt:
             logging.info("\r\nReceived interrupt. Closing...")
-            self.__stop = True
-            collector_thread.join()
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+            self._close_stats()
+            self._results()
+
+    def replay(self, filename, speed=None, buffer_size=None):
+        """
+        Feed packets of the capture through the live pipeline.
+
+        Args:
+            filename: pcap or pcapng file, may be compressed
+            speed: None to replay as fast as possible, otherwise the
+                timestamps are divided by speed (1 is the original pace)
+            buffer_size: bytes of the capture buffer of the paced
+                replay, packets which don't fit in it are dropped
+        Returns:
+            dict: report, see _report
+        """
+        if buffer_size is None:
+            buffer_size = REPLAY_BUFFER
+
+        if self.results is not None:
+            with open(self.results, "w") as fid:
+                fid.write(RESULTS_HEADER)
+
+        threads = self._threads()
+        if threads is None:
+            return None
+
+        self.latencies = []
+        started = time()
+        try:
+            with open_capture(filename) as records:
+                # Length on the wire as libpcap gives it to the callback
+                packets = ((timestamp, data, records.origlen)
+                           for timestamp, data in records)
+                if speed is not None:
+                    packets = self._paced(packets, speed, buffer_size)
+                for timestamp, data, length in packets:
+                    self._process_packet(length, data, timestamp)
+        except KeyboardInterrupt:
+            logging.info("\r\nReceived interrupt. Closing...")
+        finally:
+            # Flows in the queue are classified before the collector stops
+            self.stop()
+            collector, status = threads
+            collector.join()
+            elapsed = time() - started
+            status.join()
+
+        report = self._report(filename, elapsed)
+        self._close_stats()
+        self._results()
+
+        return report
+
+    def _paced(self, records, speed, buffer_size):
+        """
+        Packets at the pace of their timestamps. Packets wait in the
+        buffer while the previous ones are processed, the ones which
+        arrive when the buffer is full are dropped as the kernel does.
+        Packets are (timestamp, data, length on the wire).
+        """
+        pending = deque()
+        size = 0
+        start = None
+        for timestamp, data, length in records:
+            if start is None:
+                start = time()
+                first = timestamp
+            due = start + (timestamp - first) / speed
+
+            while pending and time() < due:
+                packet = pending.popleft()
+                size -= len(packet[1])
+                yield packet
+
+            delay = due - time()
+            if delay > 0:
+                sleep(delay)
+
+            if size + len(data) > buffer_size:
+                self.dropped += 1
+                continue
+            pending.append((timestamp, data, length))
+            size += len(data)
+
+        while pending:
+            yield pending.popleft()
+
+    def _report(self, filename, elapsed):
+        """
+        Log the throughput and the latency of the replay.
+
+        Returns:
+            dict: packets, dropped, flows, classified, seconds, rates and
+                latency percentiles in seconds
+        """
+        received = self.pcounter + self.dropped
+        latencies = np.array(self.latencies)
+        report = {
+            "file": filename,
+            "seconds": elapsed,
+            "packets": self.pcounter,
+            "dropped": self.dropped,
+            "loss": float(self.dropped) / received if received else 0.0,
+            "flows": self.fcounter,
+            "classified": self.classified,
+            "packets_per_second": self.pcounter / elapsed,
+            "flows_per_second": self.fcounter / elapsed,
+            "latency": {}
+        }
+        if len(latencies):
+            report["latency"] = dict(
+                ("p{0}".format(i), np.percentile(latencies, i))
+                for i in LATENCY_PERCENTILES
+            )
+            report["latency"]["mean"] = latencies.mean()
+            report["latency"]["max"] = latencies.max()
 
-            if self.results is not None:
-                self._export_json(self.results)
-                logging.info("\rResults saved in [{0}]".format(self.results))
+        logging.info(
+            "\rReplay of [{0}] took {1:.3f} s".format(filename, elapsed))
+        logging.info(
+            "Packets: {0} ({1:.0f} pkt/s), dropped {2} ({3:.2%})".format(
+                self.pcounter, report["packets_per_second"], self.dropped,
+                report["loss"]))
+        logging.info(
+            "Flows: {0} ({1:.0f} flow/s), classified {2}".format(
+                self.fcounter, report["flows_per_second"], self.classified))
+        if report["latency"]:
+            logging.info("Threshold to verdict, ms: {0}".format(", ".join(
+                "{0} {1:.3f}".format(name, report["latency"][name] * 1000)
+                for name in ["p{0}".format(i) for i in LATENCY_PERCENTILES] +
+                ["mean", "max"]
+            )))
+
+        return report
 
 
 parser = argparse.ArgumentParser(description="Protocol mapper.")
@@ -218,14 +672,88 @@ parser.add_argument(
     type=str,
     help="Results file. If None results not beeing save."
 )
+parser.add_argument(
+    "--idle",
+    type=float,
+    help="Seconds without packets after which the flow is forgotten."
+)
+parser.add_argument(
+    "--active",
+    type=float,
+    help="Seconds since the first packet after which the flow is forgotten."
+)
+parser.add_argument(
+    "--replay",
+    type=str,
+    help="Capture file to feed through the mapper instead of an interface."
+)
+parser.add_argument(
+    "--speed",
+    type=float,
+    help="Replay at the pace of the timestamps divided by speed, "
+         "1 is the original pace. As fast as possible by default."
+)
+parser.add_argument(
+    "--buffer",
+    type=int,
+    help="Capture buffer of the paced replay in bytes, packets which "
+         "don't fit are dropped. It's [{0}] by default.".format(
+             REPLAY_BUFFER)
+)
+parser.add_argument(
+    "--report",
+    type=str,
+    help="JSON file for the replay report."
+)
+parser.add_argument(
+    "--sklearn",
+    action="store_true",
+    help="Classify by the sklearn model as is, without compiling its trees."
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    help="How many ready flows are classified at once. "
+         "It's [{0}] by default.".format(BATCH_SIZE)
+)
+parser.add_argument(
+    "--batch-delay",
+    type=float,
+    help="Seconds a ready flow waits for others to be classified with. "
+         "It's [{0}] by default.".format(BATCH_DELAY)
+)
+parser.add_argument(
+    "--stats-file",
+    type=str,
+    help="JSON file with the stage timings and counters, rewritten every "
+         "[{0}] seconds.".format(STATS_INTERVAL)
+)
+parser.add_argument(
+    "--stats-port",
+    type=int,
+    help="Serve the stage timings and counters in the Prometheus text "
+         "format on http://127.0.0.1:PORT/metrics."
+)
 
 
 def main():
     args = parser.parse_args()
     if args.list:
         _interface_list()
+    elif args.replay is not None:
+        mapper = Mapper(args.threshold, args.model, args.features,
+                        args.results, args.idle, args.active,
+                        args.batch_size, args.batch_delay,
+                        not args.sklearn, args.stats_file, args.stats_port)
+        report = mapper.replay(args.replay, args.speed, args.buffer)
+        if report is not None and args.report is not None:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=1, sort_keys=True)
     elif args.interface is not None:
-        mapper = Mapper(args.threshold, args.model, args.features, args.results)
+        mapper = Mapper(args.threshold, args.model, args.features,
+                        args.results, args.idle, args.active,
+                        args.batch_size, args.batch_delay,
+                        not args.sklearn, args.stats_file, args.stats_port)
         mapper.start(args.interface)
     else:
         parser.print_help()
@@ -1,57 +1,283 @@
 #!/usr/bin/env python
 
+from Queue import Empty
 from datetime import datetime
-from multiprocessing import Process, Value, Lock
+from datetime import timedelta
+from multiprocessing import Pool, Process, Queue, Lock, Event, cpu_count
+from pktmapper import dataset
 from pktmapper import preprocessing
+from pktmapper import vectorized
+from pktmapper.cache import Cache
+from pktmapper.expiry import Expiry
+from pktmapper.flowtable import FlowTable
+from pktmapper.flowtable import HIGH_IP
+from pktmapper.flowtable import LOW_IP
+from pktmapper.manifest import Manifest
+from pktmapper.partial import Partial
+from pktmapper.pcapfile import Reader
+from pktmapper.pcapfile import StreamReader
+from pktmapper.pcapfile import is_compressed
+from pktmapper.pcapfile import open_capture
 
 import argparse
-import dpkt
+import cPickle
+import numpy as np
 import os
+import shutil
+import signal
 import sys
+import tempfile
+import threading
 import time
+import traceback
+import zlib
+
+
+ENGINES = ("scalar", "numpy")
+FORMATS = ("csv", "npy")
+
+# How many expired flows are collected before writing them out
+EXPORT_BATCH = 10000
+
+# Prepro instance of the file which is split among shard workers.
+# Workers are forked, so they get it without pickling the labels.
+_SHARDED = None
+
+
+def _part(task):
+    return _SHARDED._packets_partial(*task)
+
+
+def _shard(task):
+    return _SHARDED._packets_shard(*task)
+
+
+def _shard_of(fid, shards):
+    """
+    Shard of the flow by its key.
+    """
+    return (zlib.crc32(fid) & 0xffffffff) % shards
+
+
+# Packets processed by a worker between progress reports
+PROGRESS_BATCH = 4096
+# Seconds between updates of the status line
+STATUS_INTERVAL = 0.1
+# Seconds the workers have to leave after Ctrl-C before they are killed
+STOP_TIMEOUT = 10
+
+
+class Interrupted(Exception):
+    """
+    multi() is stopping, the worker leaves at its next progress report.
+    """
+
+
+def _human(value):
+    for unit in ("", "k", "M", "G"):
+        if value < 1000:
+            break
+        value /= 1000.0
+    return "{0:.1f}{1}".format(value, unit)
+
+
+class Status:
+    """
+    Progress of the files processed by multi(). Workers send events
+    to the queue and don't share any counters:
+
+        ("start", filename, size)
+        ("ndpi", filename, running)
+        ("progress", filename, bytes, packets)
+        ("finish", filename)
+        ("exit", filename, error)
+    """
+
+    def __init__(self, total, count):
+        """
+        Args:
+            total: bytes of all files to process
+            count: number of files
+        """
+        self.total = total
+        self.count = count
+        # Length of the previous line, shorter one has to cover it
+        self.width = 0
+        self.started = time.time()
+        # filename: [size, bytes, packets, start time, running nDPI]
+        self.files = {}
+        self.finished = []
+        self.bytes = 0
+        self.packets = 0
+
+    def handle(self, event):
+        kind, filename = event[:2]
+        if kind == "start":
+            self.files[filename] = [event[2], 0, 0, time.time(), False]
+        elif kind == "ndpi":
+            self.files[filename][4] = event[2]
+        elif kind == "progress":
+            # shard workers may report after the file is finished
+            info = self.files.get(filename)
+            if info is not None:
+                info[1] += event[2]
+                info[2] += event[3]
+            self.bytes += event[2]
+            self.packets += event[3]
+        elif kind == "finish":
+            self.finished.append(filename)
+            self.files.pop(filename, None)
+        elif kind == "exit":
+            self.files.pop(filename, None)
+
+    def _rates(self, size, done, packets, started):
+        elapsed = max(time.time() - started, 1e-6)
+        byte_rate = done / elapsed
+        if byte_rate:
+            eta = str(timedelta(seconds=int((size - done) / byte_rate)))
+        else:
+            eta = "-"
+
+        return "{0:.1f}% {1}pkt/s {2}B/s ETA {3}".format(
+            done * 100.0 / size if size else 100.0,
+            _human(packets / elapsed), _human(byte_rate), eta)
+
+    def line(self):
+        """
+        Status line: all files, then every file in progress.
+        """
+        parts = ["Completed: {0} [{1}/{2} files]".format(
+            self._rates(self.total, self.bytes, self.packets, self.started),
+            len(self.finished), self.count
+        )]
+
+        for filename in sorted(self.files):
+            size, done, packets, started, ndpi = self.files[filename]
+            if ndpi:
+                rates = "nDPI"
+            else:
+                rates = self._rates(size, done, packets, started)
+            parts.append("{0}: {1}".format(os.path.basename(filename),
+                                           rates))
+
+        line = " | ".join(parts)
+        width = self.width
+        self.width = len(line)
+        return line.ljust(width)
 
 
 class Prepro:
 
-    def __init__(self, threshold, processes):
+    def __init__(self, threshold, processes, engine=None, idle=None,
+                 active=None, cache=None, shards=None, output_format=None,
+                 volume=True):
         self.DPI = {}
-        self.FLOWS = {}
+        self.cache = cache
+        self.shards = shards or 1
+        self.FLOWS = FlowTable()
+        self.ROWS = []
+        self.EXPIRED = []
+        # Flows past the threshold:
+        # raw header: (key, proto, counters, index in the counters)
+        self.elephants = {}
+        # key: [packets, payload] to the low endpoint, to the high one.
+        # They are added to the flow table by _settle()
+        self.counters = {}
+        # Count packets and bytes of the flows past the threshold
+        self.volume = volume
+        self.output = None
+        self.filename = None
+        # Rows of the worker processes go to the writer of multi()
+        self.queue = None
+        # Files stored by the writer and the error of the output
+        self.written = set()
+        self.write_error = None
+        self.expiry = Expiry(idle, active)
 
-        self.tasks = Value("d", 0.0)
-        self.completed = Value("d", 0.0)
-        self.ndpi = Value("i", 0)
+        # Progress events go to the Status of multi()
+        self.progress = None
         self.lock = Lock()
+        # Set by multi() on Ctrl-C
+        self.stopping = Event()
+        # Workers were killed, the queues may be broken
+        self.killed = False
 
         if processes is not None:
             self.max_processes = processes
         else:
-            self.max_processes = 15
+            self.max_processes = cpu_count()
 
         if threshold is not None:
             self.threshold = threshold
         else:
             self.threshold = 8
 
-        print "[{0}] Program started. Threshold: {1}, Processes: {2}".format(
-            self._print_time(), self.threshold, self.max_processes)
+        if engine is not None:
+            self.engine = engine
+        else:
+            self.engine = "scalar"
+
+        if output_format is not None:
+            self.format = output_format
+        else:
+            self.format = "csv"
+
+        print "[{0}] Program started. Threshold: {1}, Processes: {2}, " \
+            "Engine: {3}, Timeouts: {4}/{5}, Shards: {6}".format(
+                self._print_time(), self.threshold, self.max_processes,
+                self.engine, idle, active, self.shards)
 
     def _packets_processing(self, pcap):
         """
         Packet processing.
+        Progress is counted in bytes of the file consumed.
+        Packets of unlabeled flows are dropped by raw header bytes.
+        Packets of the flows past the threshold are found by raw header
+        bytes too and only their payload length is read.
         """
+        raw_keys = set(preprocessing.raw_keys(self.DPI["flows"]))
+        plain_at = preprocessing.PLAIN_IPV4_AT
+        plain = preprocessing.PLAIN_IPV4
+        headers = preprocessing.PLAIN_HEADERS
+        elephants = self.elephants = {}
+        self.counters = {}
+        expiry = self.expiry.enabled
+        live = self.FLOWS.live
+
+        done = 0
+        packets = 0
         for timestamp, data in pcap:
-            pkt = preprocessing.packet_data(data)
+            packets += 1
+            if packets == PROGRESS_BATCH:
+                self._report("progress", pcap.filename,
+                             pcap.position - done, packets)
+                done = pcap.position
+                packets = 0
 
-            with self.lock:
-                self.completed.value += 1
+            if data[plain_at] == plain:
+                raw = data[headers]
+                if raw not in raw_keys:
+                    continue
 
+                elephant = elephants.get(raw)
+                if elephant is not None:
+                    pkt = preprocessing.plain_payload(data)
+                    if pkt is not None and pkt[0] == elephant[1] and \
+                            (not expiry or self._alive(elephant[0],
+                                                       timestamp)):
+                        counters, i = elephant[2], elephant[3]
+                        counters[i] += 1
+                        counters[i + 1] += pkt[1]
+                        continue
+
+            pkt = preprocessing.packet_data(data)
             if pkt is not None:
-                transport, ip_a, ip_b, port_a, port_b, payload = pkt
+                proto, ip_a, ip_b, port_a, port_b, payload = pkt
             else:
                 continue
 
-            fid = preprocessing.flow_hash(
-                ip_a, ip_b, port_a, port_b, transport
+            fid = preprocessing.flow_key(
+                ip_a, ip_b, port_a, port_b, proto
             )
 
             if fid in self.DPI["flows"]:
@@ -59,147 +285,770 @@ class Prepro:
             else:
                 continue
 
-            if fid in self.FLOWS and \
-                    (self.FLOWS[fid][1] + self.FLOWS[fid][2]) >= \
-                    self.threshold:
-                        preprocessing.soft_recalc(
-                            fid, payload, ip_a, self.FLOWS
-                        )
+            if self.expiry.enabled:
+                self._expire(timestamp)
+
+            flow = live.get(fid)
+            if flow is not None:
+                flow.update(payload, timestamp, ip_a)
+                if flow.packets >= self.threshold:
+                    self.FLOWS.freeze(fid)
+                    self._grown(fid, proto, raw_keys)
             else:
-                preprocessing.flow_processing(
-                    fid,
-                    payload,
-                    timestamp,
-                    ip_a,
-                    self.FLOWS,
-                    app
-                )
-
-    def _count(self, filename):
-        with open(filename) as fiid:
-            pcap = dpkt.pcap.Reader(fiid)
-            c = 0
-            for i in pcap:
-                c += 1
-        return c
-
-    def _pcap(self, filename):
+                row = self.FLOWS.row(fid)
+                if row is None:
+                    self.FLOWS.add(fid, app, payload, timestamp, ip_a)
+                    if self.expiry.enabled:
+                        self.expiry.add(fid, timestamp)
+                    if self.threshold <= 1:
+                        self.FLOWS.freeze(fid)
+                        self._grown(fid, proto, raw_keys)
+                    continue
+                elif self.volume:
+                    self.FLOWS.count(row, payload, ip_a)
+
+            if self.expiry.enabled:
+                self.expiry.touch(fid, timestamp)
+
+        self._settle(self.counters.keys())
+        self._report("progress", pcap.filename, pcap.size - done, packets)
+
+    def _grown(self, fid, proto, raw_keys):
         """
-        Read pcap file and create ground truth file.
+        The flow has passed the threshold, its next packets take the
+        header-only path.
         """
-        with self.lock:
-            self.ndpi.value += 1
-            self.DPI = preprocessing.ndpi_processing(filename)
-            self.ndpi.value -= 1
-        with self.lock:
-            self.tasks.value += self._count(filename)
-        with open(filename) as fiid:
-            pcap = dpkt.pcap.Reader(fiid)
-            self._packets_processing(pcap)
+        if any(fid[:-1] + chr(other) in self.DPI["flows"]
+               for other in preprocessing.PROTOCOLS if other != proto):
+            # Raw headers don't tell the flows apart
+            return
 
-    def _print_time(self):
+        if not self.volume and not self.expiry.enabled:
+            # Nothing to do with their packets at all
+            raw_keys.difference_update(preprocessing.raw_headers(fid))
+            return
+
+        counters = self.counters[fid] = [0, 0, 0, 0]
+        to_high, to_low = preprocessing.raw_headers(fid)
+        self.elephants[to_low] = (fid, proto, counters, 0)
+        self.elephants[to_high] = (fid, proto, counters, 2)
+
+    def _alive(self, fid, timestamp):
         """
-        Internal use.
+        Expire flows by the packet of the flow past the threshold.
+
+        Returns:
+            bool: False if the flow has expired and the packet starts
+                a new one
         """
-        return datetime.now()
+        self._expire(timestamp)
+        if fid not in self.FLOWS:
+            return False
+
+        self.expiry.touch(fid, timestamp)
+        return True
+
+    def _settle(self, fids):
+        """
+        Add counters of the flows past the threshold to the flow table.
+        """
+        for fid in fids:
+            counters = self.counters.pop(fid, None)
+            if counters is None:
+                continue
+
+            for raw in preprocessing.raw_headers(fid):
+                self.elephants.pop(raw, None)
+
+            if not self.volume:
+                continue
+            row = self.FLOWS.row(fid)
+            if counters[0]:
+                self.FLOWS.count(row, counters[1], fid[LOW_IP], counters[0])
+            if counters[2]:
+                self.FLOWS.count(row, counters[3], fid[HIGH_IP], counters[2])
 
-    def _lock_file(self, filename):
-        with open(filename + ".lock", "w"):
-            pass
+    def _expire(self, timestamp):
+        """
+        Move flows which are timed out from the flow table to the output.
+        """
+        expired = self.expiry.expire(timestamp)
+        if not expired:
+            return
 
-    def _unlock_file(self, filename):
-        if os.path.exists(filename):
-            os.remove(filename + ".lock")
+        self._settle(expired)
+        self.EXPIRED.extend(self.FLOWS.export(expired))
+        for fid in expired:
+            self.FLOWS.remove(fid)
+        if len(self.EXPIRED) >= EXPORT_BATCH:
+            self._write(self.output, self.EXPIRED)
+            self.EXPIRED = []
+
+    def _packets_vectorized(self, pcap):
+        """
+        Packet processing with the numpy engine.
+        Packets are decoded into columns and all features are
+        calculated at once. Progress is reported by chunks of records.
+        """
+        def progress(size, packets):
+            self._report("progress", pcap.filename, size, packets)
 
-    def _is_locked(self, filename):
-        if os.path.exists(filename + ".lock"):
-            return True
+        if isinstance(pcap, Reader):
+            keys, timestamps, flows, directions, payloads = \
+                vectorized.decode_index(pcap, self.DPI["flows"], progress)
         else:
-            return False
+            keys, timestamps, flows, directions, payloads = \
+                vectorized.decode(pcap, self.DPI["flows"], progress)
+
+        matrix = vectorized.features(
+            timestamps, flows, directions, payloads, len(keys),
+            self.threshold, self.volume
+        )
 
-    def _status(self):
+        self.ROWS = zip(
+            vectorized.rows(matrix),
+            (self.DPI["flows"][fid] for fid in keys)
+        )
+
+    def _packets_sharded(self, pcap):
+        """
+        Packet processing of one file by several processes in two
+        steps. Every worker collects flows of its byte range of the
+        file and spools them by the shard of the flow key. Then every
+        worker merges partial flows of one shard in the order of ranges
+        and sends back rows of the complete flows, the parent only
+        joins them.
+        """
+        global _SHARDED
+        _SHARDED = self
+
+        spool = tempfile.mkdtemp()
+        pool = Pool(self.shards)
         try:
-            if self.ndpi.value > 0:
-                proc = 0.0
+            parts = pcap.split(self.shards)
+            pool.map(
+                _part,
+                [(pcap.filename, spool, i) + part
+                 for i, part in enumerate(parts)],
+                chunksize=1
+            )
+            rows = pool.map(
+                _shard,
+                [(spool, len(parts), i) for i in xrange(self.shards)],
+                chunksize=1
+            )
+        finally:
+            pool.close()
+            pool.join()
+            _SHARDED = None
+            shutil.rmtree(spool)
+
+        self.ROWS = [row for shard in rows for row in shard]
+
+    def _packets_partial(self, filename, spool, part, start, stop, state):
+        """
+        Collect flows of the byte range of the file, partial flows of
+        every shard go to their own file of the spool.
+        """
+        with Reader(filename) as pcap:
+            partials = self._collect(pcap, pcap.part(start, stop, state),
+                                     start, stop, self.DPI["flows"],
+                                     self.shards)
+
+        for shard, partial in enumerate(partials):
+            with open(os.path.join(spool, "{0}.{1}".format(part, shard)),
+                      "wb") as f:
+                cPickle.dump(partial, f, -1)
+
+    def _packets_shard(self, spool, parts, shard):
+        """
+        Merge partial flows of the shard collected from every range.
+
+        Returns:
+            list: rows of the flows as _rows() gives them
+        """
+        partial = None
+        for part in xrange(parts):
+            with open(os.path.join(spool, "{0}.{1}".format(part, shard)),
+                      "rb") as f:
+                other = cPickle.load(f)
+            if partial is None:
+                partial = other
             else:
-                proc = round(self.completed.value / self.tasks.value * 100, 2)
-        except ZeroDivisionError:
-            proc = 0
+                partial.merge(other)
+
+        # A worker may merge several shards, each one gets its own table
+        table = FlowTable()
+        partial.replay(table, self.DPI["flows"])
+        return table.export()
+
+    def _collect(self, pcap, records, start, stop, labels, shards=1):
+        """
+        Collect flows of the records.
+
+        Args:
+            pcap: reader of the records, for the progress
+            records: iterable of (timestamp, data)
+            start, stop: byte range of the records
+            labels: flows to collect, None for all flows
+            shards: how many parts the flows are split into by key
+        Returns:
+            list: Partial of every shard
+        """
+        partials = [Partial(self.threshold, self.volume)
+                    for _ in xrange(shards)]
+        partial = partials[0]
+
+        if labels is not None:
+            raw_keys = preprocessing.raw_keys(labels)
+        plain_at = preprocessing.PLAIN_IPV4_AT
+        plain = preprocessing.PLAIN_IPV4
+        headers = preprocessing.PLAIN_HEADERS
+
+        done = start
+        packets = 0
+        for timestamp, data in records:
+            packets += 1
+            if packets == PROGRESS_BATCH:
+                self._report("progress", pcap.filename,
+                             pcap.position - done, packets)
+                done = pcap.position
+                packets = 0
 
-        sys.stdout.write(
-            "\rCompleted: {0}%".format(
-                proc
+            if labels is not None and data[plain_at] == plain and \
+                    data[headers] not in raw_keys:
+                continue
+
+            pkt = preprocessing.packet_data(data)
+            if pkt is None:
+                continue
+            proto, ip_a, ip_b, port_a, port_b, payload = pkt
+
+            fid = preprocessing.flow_key(
+                ip_a, ip_b, port_a, port_b, proto
             )
-        )
+            if labels is None or fid in labels:
+                if shards > 1:
+                    partial = partials[_shard_of(fid, shards)]
+                partial.add(fid, payload, timestamp, ip_a)
+
+        self._report("progress", pcap.filename, stop - done, packets)
+
+        return partials
+
+    def _rows(self):
+        """
+        Features and application of every processed flow.
+        """
+        for row in self.FLOWS.export():
+            yield row
+
+        for row in self.EXPIRED:
+            yield row
+
+        for row in self.ROWS:
+            yield row
+
+    def _pcap(self, filename, engine):
+        """
+        Read pcap file and create ground truth file.
+        """
+        self._report("start", filename, os.path.getsize(filename))
+
+        dpi = None
+        if self.cache is not None:
+            dpi, key = self.cache.get(filename)
+
+        if dpi is None and is_compressed(filename):
+            partial = self._pcap_tee(filename)
+            if self.cache is not None:
+                self.cache.put(key, self.DPI)
+            if partial is not None:
+                partial.replay(self.FLOWS, self.DPI["flows"])
+                return
+            dpi = self.DPI
+
+        with open_capture(filename) as pcap:
+            if dpi is not None:
+                self.DPI = dpi
+            else:
+                with self.lock:
+                    self._check()
+                    self._report("ndpi", filename, True)
+                    ndpi = preprocessing.ndpi_start(filename)
+                    if engine == "numpy":
+                        # Header scan runs while nDPI reads the same file
+                        pcap.index()
+                    self.DPI = preprocessing.ndpi_collect(ndpi)
+                    self._report("ndpi", filename, False)
+
+                if self.cache is not None:
+                    self.cache.put(key, self.DPI)
+
+            if self.shards > 1 and isinstance(pcap, Reader):
+                self._packets_sharded(pcap)
+            elif engine == "numpy":
+                self._packets_vectorized(pcap)
+            else:
+                self._packets_processing(pcap)
+
+    def _pcap_tee(self, filename):
+        """
+        Decompress the file once for nDPI and for us: nDPI reads a copy
+        of the stream from a named pipe. Flows are collected without
+        labels meanwhile and filtered when nDPI is done.
+
+        With timeouts packets can't be processed before labels are
+        known, then the stream is only passed to nDPI.
+
+        Returns:
+            Partial: all flows of the file or None with timeouts
+        """
+        tmp_dir = tempfile.mkdtemp()
+        fifo = os.path.join(tmp_dir, os.path.basename(filename))
+        os.mkfifo(fifo)
+
+        try:
+            # nDPI is paced by our own decompression here, only its start
+            # and the parsing of its output are serialized with the other
+            # workers. The stream is read outside the lock.
+            with self.lock:
+                self._check()
+                if self.expiry.enabled:
+                    self._report("ndpi", filename, True)
+                ndpi = preprocessing.ndpi_start(fifo)
+
+            partial = None
+            try:
+                with StreamReader(filename, tee=fifo) as pcap:
+                    if self.expiry.enabled:
+                        for record in pcap:
+                            pass
+                    else:
+                        partial, = self._collect(pcap, pcap, 0,
+                                                 pcap.size, None)
+            except:
+                preprocessing.ndpi_cancel(ndpi)
+                raise
+
+            with self.lock:
+                self.DPI = preprocessing.ndpi_collect(ndpi)
+                self._report("ndpi", filename, False)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        return partial
+
+    def _print_time(self):
+        """
+        Internal use.
+        """
+        return datetime.now()
+
+    def _report(self, *event):
+        """
+        Send the progress event to multi(). See Status.
+
+        Raises:
+            Interrupted: on the progress event once multi() is stopping
+        """
+        if self.progress is not None:
+            if event[0] == "progress":
+                self._check()
+            self.progress.put(event)
+
+    def _check(self):
+        """
+        Raises:
+            Interrupted: once multi() is stopping
+        """
+        if self.stopping.is_set():
+            raise Interrupted()
+
+    def _status(self, status):
+        sys.stdout.write("\r" + status.line())
         sys.stdout.flush()
 
     def export(self, filename, output):
         """
         Save flows in an appropriate format
         """
-        while self._is_locked(output):
-            time.sleep(1)
+        self._write(output, self._rows())
 
-        self._lock_file(output)
-        f = open(output, "a")
+    def _write(self, output, rows):
+        """
+        Append rows of features and application to the output.
+        Inside multi() rows are sent to the writer in batches.
+        """
+        def _round(val):
+            if isinstance(val, float):
+                if val == 0.0:
+                    return "0"
+                return str(round(val, 6))
+            else:
+                return str(val)
 
-        for metrics in self.FLOWS.values():
-            tmp = metrics[1:25]
-            app = metrics[0]
+        features = []
+        apps = []
+        for tmp, app in rows:
+            if self.format == "npy":
+                features.append(tmp)
+            else:
+                tmp = map(_round, tmp)
+                features.append("{0},{1}\n".format(",".join(tmp), app))
+            apps.append(app)
 
-            def _round(val):
-                if isinstance(val, float):
-                    if val == 0.0:
-                        return "0"
-                    return str(round(val, 6))
-                else:
-                    return str(val)
+            if len(apps) == EXPORT_BATCH:
+                self._send(output, features, apps)
+                features = []
+                apps = []
 
-            tmp = map(_round, tmp)
-            f.write("{0},{1}\n".format(",".join(tmp), app))
+        if apps:
+            self._send(output, features, apps)
 
-        self._unlock_file(output)
+    def _send(self, output, features, apps):
+        if self.format == "npy":
+            batch = (np.array(features, dtype=dataset.FEATURES_DTYPE), apps)
+        else:
+            batch = "".join(features)
+
+        if self.queue is not None:
+            self.queue.put(("rows", self.filename, batch))
+        else:
+            f = self._open(output)
+            self._store(f, batch)
+            f.close()
+
+    def _open(self, output):
+        if self.format == "npy":
+            return dataset.Writer(output)
+        return open(output, "a")
+
+    def _store(self, f, batch):
+        if self.format == "npy":
+            f.write(*batch)
+        else:
+            f.write(batch)
+
+    def _position(self, f):
+        """
+        End of the output: rows of the dataset or bytes of CSV.
+        """
+        if self.format == "npy":
+            return f.rows
+        f.flush()
+        return os.fstat(f.fileno()).st_size
+
+    def _params(self):
+        """
+        Parameters which change the output of a capture.
+        """
+        params = {
+            "threshold": self.threshold,
+            "idle": self.expiry.idle,
+            "active": self.expiry.active,
+            "format": self.format
+        }
+        if not self.volume:
+            # Manifests of the runs before the option stay valid
+            params["volume"] = False
+
+        return params
+
+    def _recover(self, output, manifest):
+        """
+        Cut rows of the interrupted commit off the output.
+        """
+        if not os.path.exists(output):
+            manifest.recover(0)
+            return
+
+        f = self._open(output)
+        try:
+            end = manifest.recover(self._position(f))
+            if end is not None:
+                f.truncate(end)
+        finally:
+            f.close()
+
+    def _writer(self, output, manifest=None, keys=None):
+        """
+        The only one who writes to the output in multi().
+
+        With the manifest rows of every file are spooled to a temporary
+        file and appended to the output when the file is finished, so
+        rows of failed files never get there.
+
+        Files whose rows are all stored go to self.written. An error of
+        the output is kept in self.write_error, rows which come after it
+        are dropped until the workers are done.
+        """
+        spool = {}
+        try:
+            f = self._open(output)
+            try:
+                for kind, filename, batch in iter(self.queue.get, None):
+                    if manifest is None:
+                        if kind == "rows":
+                            self._store(f, batch)
+                        else:
+                            self.written.add(filename)
+                        continue
+
+                    if kind == "rows":
+                        if filename not in spool:
+                            spool[filename] = tempfile.TemporaryFile()
+                        cPickle.dump(batch, spool[filename], -1)
+                        continue
+
+                    key, fp = keys[filename]
+                    manifest.begin(key, filename, fp, self._params(),
+                                   self._position(f))
+
+                    tmp = spool.pop(filename, None)
+                    if tmp is not None:
+                        tmp.seek(0)
+                        while True:
+                            try:
+                                self._store(f, cPickle.load(tmp))
+                            except EOFError:
+                                break
+                        tmp.close()
+
+                    manifest.finish(key, self._position(f))
+                    self.written.add(filename)
+            finally:
+                f.close()
+        except Exception:
+            self.write_error = traceback.format_exc()
+            for event in iter(self.queue.get, None):
+                pass
+        finally:
+            for tmp in spool.values():
+                tmp.close()
+
+    def pcap(self, filename, output, engine=None):
+        if engine is None:
+            engine = self.engine
 
-    def pcap(self, filename, output):
         print "\r[{0}] Start processing [{1}]".format(
             self._print_time(), filename
         )
-        self._pcap(filename)
+        self.output = output
+        self.filename = filename
+        self._pcap(filename, engine)
         self.export(filename, output)
+        if self.queue is not None:
+            self.queue.put(("done", filename, None))
+        self._report("finish", filename)
         print "\r[{0}] Finish processing [{1}]".format(
             self._print_time(), filename
         )
 
-    def multi(self, datainput, output):
+    def multi(self, datainput, output, resume=True):
+        """
+        Process the file or all files of the directory.
+
+        With resume the manifest of the output is kept: files which are
+        already in the output are skipped and rows of the files which
+        weren't finished are not written.
+        """
         if os.path.isdir(datainput):
             queue = [os.path.join(datainput, pa) for pa in os.listdir(datainput)]
         else:
             queue = [datainput]
 
         queue = [i for i in queue if os.path.isfile(i)]
-        processes = []
-
-        if len(queue) > 0:
-            while len(queue) > 0:
-                for fu in queue:
-                    if len(processes) < self.max_processes:
-                        processes.append(
-                            Process(target=self.pcap, args=(fu, output,))
-                        )
-                        processes[-1].start()
-                        queue.remove(fu)
-
-                while len(processes) > 0:
-                    self._status()
-                    for i in processes:
-                        if not i.is_alive():
-                            i.join()
-                            processes.remove(i)
-
-                    time.sleep(0.1)
-                    if len(queue) > 0:
-                        break
-        print
+
+        manifest = None
+        keys = {}
+        if resume:
+            manifest = Manifest(output.rstrip(os.sep) + ".manifest", output)
+            self._recover(output, manifest)
+
+            params = self._params()
+            for fu in list(queue):
+                keys[fu] = manifest.key(fu, params)
+                if manifest.done(keys[fu][0]):
+                    print "[{0}] Skip processed [{1}]".format(
+                        self._print_time(), fu
+                    )
+                    queue.remove(fu)
+
+        self.queue = Queue()
+        self.written = set()
+        self.write_error = None
+        self.killed = False
+        self.stopping.clear()
+        writer = threading.Thread(target=self._writer,
+                                  args=(output, manifest, keys))
+        # It never finishes if a killed worker has broken the queue
+        writer.daemon = True
+        writer.start()
+
+        self.progress = Queue()
+        status = Status(sum(os.path.getsize(i) for i in queue), len(queue))
+
+        # Longest processing time first: the largest files start first
+        queue.sort(key=os.path.getsize, reverse=True)
+
+        results = {}
+        try:
+            self._schedule(queue, output, status, results)
+        finally:
+            self.queue.put(None)
+            if self.killed:
+                self.queue.cancel_join_thread()
+                writer.join(STOP_TIMEOUT)
+            else:
+                writer.join()
+            self.queue = None
+            self.progress = None
+
+            if self.write_error is not None:
+                self._unwritten(queue, results)
+
+            self._status(status)
+            print
+            self._summary(results)
+
+        return results
+
+    def _unwritten(self, queue, results):
+        """
+        The output has failed: processed files which aren't in it and
+        the ones which weren't started fail with its error.
+        """
+        for fu in results:
+            if not results[fu]["error"] and fu not in self.written:
+                results[fu]["error"] = self.write_error
+
+        for fu in queue:
+            results[fu] = {
+                "size": os.path.getsize(fu),
+                "time": 0.0,
+                "error": self.write_error
+            }
+
+    def _task(self, filename, output):
+        """
+        Worker process of multi(). Exit event is always the last one.
+
+        Ctrl-C is ignored: the worker is stopped by multi() between its
+        progress reports, never in the middle of a put to the queues.
+        """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        error = None
+        try:
+            self.pcap(filename, output)
+        except Exception:
+            if self.stopping.is_set():
+                error = "Interrupted"
+            else:
+                error = traceback.format_exc()
+
+        self._report("exit", filename, error)
+
+    def _schedule(self, queue, output, status, results):
+        """
+        Run files of the queue in at most max_processes processes.
+
+        On Ctrl-C no more files are started and the workers are asked to
+        stop. The ones which don't leave in STOP_TIMEOUT seconds, or
+        after the second Ctrl-C, are killed.
+
+        Args:
+            results: filled with filename: {"size", "time", "error"}
+        """
+        # filename: (process, start time)
+        running = {}
+        updated = 0
+        # Time to kill the workers which are still there after Ctrl-C
+        deadline = None
+
+        while running or (queue and deadline is None and
+                          self.write_error is None):
+            try:
+                if deadline is not None and time.time() > deadline:
+                    self._kill(running, results)
+                    break
+
+                while queue and len(running) < self.max_processes and \
+                        deadline is None and self.write_error is None:
+                    fu = queue.pop(0)
+                    process = Process(target=self._task, args=(fu, output))
+                    process.start()
+                    running[fu] = (process, time.time())
+
+                try:
+                    event = self.progress.get(timeout=STATUS_INTERVAL)
+                except Empty:
+                    event = None
+
+                exited = []
+                if event is not None:
+                    status.handle(event)
+                    if event[0] == "exit":
+                        exited.append((event[1], event[2]))
+
+                for fu, (process, started) in running.items():
+                    if not process.is_alive() and process.exitcode != 0:
+                        # killed without saying goodbye
+                        exited.append((fu, "Exit code {0}".format(
+                            process.exitcode)))
+
+                for fu, error in exited:
+                    if fu not in running:
+                        continue
+                    process, started = running.pop(fu)
+                    process.join()
+                    results[fu] = {
+                        "size": os.path.getsize(fu),
+                        "time": time.time() - started,
+                        "error": error
+                    }
+
+                if time.time() - updated >= STATUS_INTERVAL:
+                    self._status(status)
+                    updated = time.time()
+
+            except KeyboardInterrupt:
+                if deadline is not None:
+                    self._kill(running, results)
+                    break
+
+                print "\r[{0}] Interrupted, waiting for the workers".format(
+                    self._print_time())
+                self.stopping.set()
+                deadline = time.time() + STOP_TIMEOUT
+
+    def _kill(self, running, results):
+        """
+        Kill the workers which haven't left. A worker killed in the
+        middle of a put may leave the queues broken, see multi().
+        """
+        self.killed = True
+        for fu, (process, started) in running.items():
+            process.terminate()
+            process.join()
+            results[fu] = {
+                "size": os.path.getsize(fu),
+                "time": time.time() - started,
+                "error": "Interrupted"
+            }
+        running.clear()
+        print "\r[{0}] Killed the workers".format(self._print_time())
+
+    def _summary(self, results):
+        failed = sorted(fu for fu, i in results.items() if i["error"])
+
+        print "[{0}] Processed: {1}, failed: {2}".format(
+            self._print_time(), len(results) - len(failed), len(failed)
+        )
+        for fu in failed:
+            print "    [{0}] {1}".format(
+                fu, results[fu]["error"].strip().splitlines()[-1])
 
 
 parser = argparse.ArgumentParser(description="PCAP preprocessing.")
@@ -219,16 +1068,84 @@ parser.add_argument(
 parser.add_argument(
     "-p", "--processes",
     type=int,
-    help="How many processes can be used for processing."
+    help="How many files are processed at once. "
+         "It's the number of CPUs by default."
+)
+parser.add_argument(
+    "--idle",
+    type=float,
+    help="Seconds without packets after which the flow is exported. "
+         "Scalar engine only."
+)
+parser.add_argument(
+    "--active",
+    type=float,
+    help="Seconds since the first packet after which the flow is exported. "
+         "Scalar engine only."
+)
+parser.add_argument(
+    "-e", "--engine",
+    choices=ENGINES,
+    help="Feature extraction engine. It's [scalar] by default."
+)
+parser.add_argument(
+    "-f", "--format",
+    choices=FORMATS,
+    help="Output format. It's [csv] by default. With npy the result is "
+         "a directory of the binary dataset, see pktmapper.dataset."
+)
+parser.add_argument(
+    "-s", "--shards",
+    type=int,
+    help="How many processes share one file. Every one reads a part of "
+         "the file, then merges one share of the flows. The scalar engine "
+         "is used. Can't be used with timeouts."
+)
+parser.add_argument(
+    "--no-volume",
+    action="store_true",
+    help="Don't count packets and bytes of the flow after the threshold."
+)
+parser.add_argument(
+    "--no-resume",
+    action="store_true",
+    help="Process all files again and don't keep the manifest of the "
+         "output."
+)
+parser.add_argument(
+    "--cache",
+    help="Directory of the nDPI results cache. "
+         "It's [~/.cache/pktmapper] by default."
+)
+parser.add_argument(
+    "--cache-size",
+    type=int,
+    default=1024,
+    help="Size limit of the cache in megabytes."
+)
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="Always run nDPI."
 )
 
 
 def main():
     args = parser.parse_args()
+    if args.shards > 1 and (args.idle is not None or args.active is not None):
+        parser.error("--shards can't be used with --idle or --active")
+
+    cache = None
+    if not args.no_cache:
+        cache = Cache(args.cache, args.cache_size << 20)
 
-    prepros = Prepro(args.threshold, args.processes)
+    prepros = Prepro(args.threshold, args.processes, args.engine,
+                     args.idle, args.active, cache, args.shards, args.format,
+                     not args.no_volume)
 
-    prepros.multi(args.file, args.result)
+    results = prepros.multi(args.file, args.result, not args.no_resume)
+    if any(i["error"] for i in results.values()):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()